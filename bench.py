@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Нагрузочная проверка бота без сети: обработчики и мониторинг вызываются
+с поддельными Bot и context на синтетических наборах форм.
+
+Для каждого размера набора: отправка форм (web_app_data_handler), /status,
+проход monitor_exit_deadlines по просроченным формам, закрытие форм ответом
+(group_reply_handler). Отдельно — журнал из --journal записей: запись,
+загрузка при запуске и выгрузка /journal с фильтром, и запись/чтение снимка журнала
+из --snapshot записей в прежнем JSON с отступами и в доступных форматах SNAPSHOT_FORMAT.
+Печатает количество операций, пропускную способность, p50/p99 и пиковую память процесса.
+
+    python bench.py
+    python bench.py --forms 100 1000 --journal 0 --storage sqlite
+    python bench.py --forms --journal 0 --snapshot 10000 100000 1000000
+    python bench.py --full     # 100…100000 форм и 1 000 000 записей журнала и снимка
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+import bot
+import serializer
+
+from records import FormRecord
+from sender import SendDispatcher
+from storage import PersistenceWorker, WriteAheadLog, atomic_write_json, read_snapshot, write_snapshot
+
+try:
+    import resource
+except ImportError:
+    # Windows: пиковая память не измеряется
+    resource = None
+
+SYSTEMS = 50
+
+
+class FakeBot:
+    """Bot без сети: сообщения получают последовательные id."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return types.SimpleNamespace(chat_id=chat_id, message_id=next(self._ids), text=text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        return True
+
+
+class FakeJob:
+    def schedule_removal(self):
+        pass
+
+
+class FakeJobQueue:
+    """Задачи не выполняются: monitor_exit_deadlines бенчмарк вызывает сам."""
+
+    def run_once(self, callback, when, **kwargs):
+        return FakeJob()
+
+
+def make_context(args=None):
+    return types.SimpleNamespace(bot=FakeBot(), job_queue=FakeJobQueue(), args=args or [])
+
+
+def make_update(user_id: int, text: str = None, web_app_data: str = None, reply_to=None, chat_id: int = None):
+    async def reply(*args, **kwargs):
+        return None
+
+    message = types.SimpleNamespace(
+        text=text,
+        reply_to_message=reply_to,
+        web_app_data=types.SimpleNamespace(data=web_app_data) if web_app_data else None,
+        reply_text=reply,
+        reply_document=reply,
+    )
+    return types.SimpleNamespace(
+        message=message,
+        effective_user=types.SimpleNamespace(id=user_id, username=f"user{user_id}", full_name=f"User {user_id}"),
+        effective_chat=types.SimpleNamespace(id=chat_id or user_id, type="private"),
+        to_dict=lambda: {},
+    )
+
+
+def peak_memory_mb() -> float:
+    if resource is None:
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux — килобайты, macOS — байты
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(q * (len(sorted_values) - 1) + 0.5))]
+
+
+def report(name: str, latencies: list) -> None:
+    latencies.sort()
+    total = sum(latencies)
+    ops = len(latencies)
+    throughput = ops / total if total else float("inf")
+    print(f"  {name:<32} {ops:>9} оп. {total:>9.3f} с {throughput:>12.0f} оп/с "
+          f"p50 {percentile(latencies, 0.5) * 1000:>8.3f} мс  p99 {percentile(latencies, 0.99) * 1000:>8.3f} мс  "
+          f"пик {peak_memory_mb():>7.0f} МБ")
+
+
+async def measure(calls) -> list:
+    """Последовательный вызов корутин-фабрик; возвращает длительность каждого вызова."""
+    latencies = []
+    for call in calls:
+        start = time.perf_counter()
+        await call()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def reset_bot(storage: str, journal: bool = True) -> None:
+    """Чистое состояние модуля bot в текущем (временном) каталоге; journal=False — как при запуске, без журнала."""
+    bot.STORAGE_BACKEND = storage
+    bot.MULTI_INSTANCE = False
+    bot.is_leader = True
+    bot.db = None
+    bot.active_forms = {}
+    bot.journal_forms = []
+    bot.journal_load_task = None
+    bot.journal_backlog = None
+    bot.pending_archive.clear()
+    bot.known_chats = {}
+    bot.report_index.clear()
+    bot.forms_by_user.clear()
+    bot.forms_by_system.clear()
+    bot.deadline_queue.clear()
+    bot.deadline_job = None
+    bot.deadline_job_at = None
+    bot.submitting_users.clear()
+    bot.rendered_active_lines.clear()
+    bot.persistence = PersistenceWorker()
+    bot.wal = WriteAheadLog(bot.WAL_FILE, bot.persistence)
+    # Лимиты Telegram здесь не проверяются
+    bot.sender = SendDispatcher(global_rate=1e9, private_rate=1e9, group_rate=1e9, group_burst=1e9)
+    bot.open_storage()
+    bot.load_forms()
+    bot.load_known_chats()
+    bot.journal_loaded = False
+    if journal:
+        bot.load_journal()
+    bot.persistence.start()
+
+
+def close_bot() -> None:
+    bot.persistence.stop()
+    if bot.db is not None:
+        bot.db.conn.close()
+
+
+def form_payload(user_id: int, date_up: str) -> str:
+    return json.dumps({
+        "name": f"Участник {user_id}",
+        "system": f"Система {user_id % SYSTEMS}",
+        "date_up": date_up,
+        "time_up": "10:00",
+        "control": "12:00",
+        "phone": "+70000000000",
+    }, ensure_ascii=False)
+
+
+async def bench_forms(count: int, storage: str) -> None:
+    print(f"Активных форм: {count}, хранилище: {storage}")
+    reset_bot(storage)
+    context = make_context()
+    # Вчерашние формы: к проходу мониторинга наступили оба срока
+    yesterday = (datetime.datetime.now(bot.TZ_LOCAL) - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+
+    report("web_app_data_handler", await measure(
+        (lambda uid=uid: bot.web_app_data_handler(make_update(uid, web_app_data=form_payload(uid, yesterday)), context))
+        for uid in range(1, count + 1)
+    ))
+
+    def cold_status():
+        bot.mark_active_forms_changed()
+        return bot.status_handler(make_update(1), context)
+
+    report("/status (после изменения)", await measure(itertools.repeat(cold_status, 20)))
+    report("/status (готовый список)", await measure(
+        itertools.repeat(lambda: bot.status_handler(make_update(1), context), 20)
+    ))
+
+    # Уведомления прохода отправляются одновременно — измеряется весь проход как одна операция
+    alerts = len(bot.deadline_queue)
+    report(f"мониторинг: проход, {alerts} ср.", await measure([lambda: bot.monitor_exit_deadlines(context)]))
+
+    replies = []
+    for form in list(bot.active_forms.values()):
+        chat_id, message_id = next(iter(form.report_pairs()))
+        reply_to = types.SimpleNamespace(chat_id=chat_id, message_id=message_id, text=form.summary)
+        replies.append((form.user_id, reply_to))
+    report("group_reply_handler", await measure(
+        (lambda uid=uid, reply_to=reply_to: bot.group_reply_handler(
+            make_update(uid, text="Вышел", reply_to=reply_to, chat_id=reply_to.chat_id), context))
+        for uid, reply_to in replies
+    ))
+
+    report("запись очереди на диск", await measure([lambda: asyncio.to_thread(bot.persistence.flush)]))
+    close_bot()
+
+
+def synthetic_journal(count: int):
+    """Записи журнала за последний год: по SYSTEMS системам, равномерно по дням."""
+    start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=365)
+    for i in range(count):
+        filled_at = start + datetime.timedelta(seconds=i * 365 * 86400 / count)
+        date_up = filled_at.astimezone(bot.TZ_LOCAL).strftime("%Y-%m-%d")
+        yield FormRecord(
+            user_id=i + 1,
+            username=f"@user{i + 1}",
+            system=f"Система {i % SYSTEMS}",
+            date_up=date_up,
+            time_up="10:00",
+            control=f"{date_up} 20:00",
+            filled_at=filled_at,
+            report_msg_ids=[i + 1],
+            chat_ids=[bot.FORM_CHAT_ID],
+        )
+
+
+async def bench_journal(count: int, storage: str) -> None:
+    print(f"Записей журнала: {count}, хранилище: {storage}")
+    reset_bot(storage)
+
+    def populate():
+        if bot.db is not None:
+            batch = []
+            for record in synthetic_journal(count):
+                uid = str(record.user_id)
+                batch.append({"op": "create", "uid": uid, "record": record.to_dict()})
+                batch.append({"op": "exit", "uid": uid})
+                if len(batch) >= 20000:
+                    bot.db.write_batch(batch)
+                    batch = []
+            bot.db.write_batch(batch)
+        else:
+            bot.journal_forms.extend(synthetic_journal(count))
+            bot.compact_storage()
+            bot.persistence.flush()
+
+    report("запись журнала", await measure([lambda: asyncio.to_thread(populate)]))
+    close_bot()
+
+    def startup():
+        reset_bot(storage, journal=False)
+        bot.build_deadline_queue()
+
+    report("запуск (активные формы)", await measure([lambda: asyncio.to_thread(startup)]))
+    report("чтение журнала после запуска", await measure([bot.ensure_journal]))
+
+    month = (datetime.datetime.now(bot.TZ_LOCAL) - datetime.timedelta(days=30)).strftime("%Y-%m")
+    month_args = [f"{month}-01", f"{month}-28"]
+    report("/journal (месяц)", await measure(
+        itertools.repeat(lambda: bot.journal_handler(make_update(1), make_context(month_args)), 3)
+    ))
+    report("/journal (месяц, система)", await measure(
+        itertools.repeat(lambda: bot.journal_handler(make_update(1), make_context(month_args + ["Система 7"])), 3)
+    ))
+    close_bot()
+
+
+def snapshot_writers():
+    """Варианты записи снимка журнала: прежний JSON с отступами и доступные форматы SNAPSHOT_FORMAT."""
+    yield "json (отступы)", lambda path, data: atomic_write_json(
+        path, {"wal_seq": 0, "journal": data}, indent=4, default=str)
+    for fmt in serializer.FORMATS:
+        if serializer.snapshot_format(fmt) == fmt:
+            yield fmt, lambda path, data, fmt=fmt: write_snapshot(path, "journal", data, 0, fmt)
+
+
+async def bench_snapshots(count: int) -> None:
+    print(f"Снимок журнала: {count} записей, JSON через {serializer.json_backend()}")
+    data = [record.to_dict() for record in synthetic_journal(count)]
+    path = "snapshot.bench"
+    for name, write in snapshot_writers():
+        report(f"запись: {name}", await measure([lambda: asyncio.to_thread(write, path, data)]))
+        report(f"чтение: {name}", await measure([lambda: asyncio.to_thread(read_snapshot, path, "journal", [])]))
+        print(f"  {'размер файла':<32} {os.path.getsize(path) / (1024 * 1024):>9.1f} МБ")
+        os.remove(path)
+
+
+async def run(args) -> None:
+    for count in args.forms:
+        await bench_forms(count, args.storage)
+    if args.journal:
+        await bench_journal(args.journal, args.storage)
+    for count in args.snapshot:
+        await bench_snapshots(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочная проверка обработчиков и мониторинга бота")
+    parser.add_argument("--forms", type=int, nargs="*", default=[100, 1000, 10000], help="размеры наборов активных форм")
+    parser.add_argument("--journal", type=int, default=100000, help="записей журнала (0 — не проверять)")
+    parser.add_argument("--snapshot", type=int, nargs="*", default=[10000, 100000],
+                        help="размеры снимка журнала для сравнения форматов записи")
+    parser.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--full", action="store_true", help="наборы 100…100000 форм и 1 000 000 записей журнала и снимка")
+    parser.add_argument("--verbose", action="store_true", help="не отключать журнал INFO бота")
+    args = parser.parse_args()
+    if args.full:
+        args.forms = [100, 1000, 10000, 100000]
+        args.journal = 1000000
+        args.snapshot = [10000, 100000, 1000000]
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    workdir = tempfile.mkdtemp(prefix="cavesmonitor_bench_")
+    cwd = os.getcwd()
+    # Файлы данных бота задаются относительными путями — пишем их во временный каталог
+    os.chdir(workdir)
+    try:
+        asyncio.run(run(args))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,30 @@ import logging
 import datetime
 import html
 import os
-import io
-
-import pandas as pd
+import heapq
+import itertools
+import asyncio
+import socket
+import tempfile
+import threading
+import time
+
+from export import table_extension, write_table
+from logs import SampleFilter, setup_logging
+from metrics import ACTIVE_FORMS, ALERT_LATENESS, start_http_server, timed
+from records import FormRecord
+from sender import SendDispatcher
+from stats import FormStats
+from webhook import run_webhook_server
+from storage import (
+    JournalArchive,
+    PersistenceWorker,
+    SQLiteStorage,
+    WriteAheadLog,
+    atomic_write_json,
+    read_snapshot,
+    write_snapshot
+)
 
 from datetime import timezone, timedelta
 
@@ -17,6 +38,7 @@ from telegram import (
     WebAppInfo,
     KeyboardButton,
     ReplyKeyboardMarkup,
+    LinkPreviewOptions,
     Chat
 )
 from telegram.constants import ParseMode, ChatType
@@ -28,7 +50,7 @@ from telegram.ext import (
     ChatMemberHandler,
     filters
 )
-from telegram.error import Conflict
+from telegram.error import BadRequest, Conflict
 
 # ------------------ ВАЖНО: ВПИСЫВАЕМ АДМИН ID ------------------
 # Здесь указываем ID пользователей, которым разрешено удалять ЛЮБЫЕ формы
@@ -48,51 +70,396 @@ FORM_CHAT_ID = -    # TODO: Замените на ID чата для форм
 ALARM_CHAT_ID = -   # TODO: Замените на ID чата для алармов и мониторинга
 # ---------------------------------------------------------------------------
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# ---------------------------------------------------------------------------
+# Получение обновлений: "polling" (по умолчанию) или "webhook".
+# Для webhook нужен aiohttp; бот слушает WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH
+# (обычно за nginx с https). Если WEBHOOK_URL пуст, адрес в Telegram не регистрируется —
+# так можно проверять бота локально, отправляя Update в JSON методом POST.
+UPDATE_MODE = "polling"
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"
+WEBHOOK_URL = ""                # например, "https://example.com/telegram"
+WEBHOOK_SECRET_TOKEN = ""       # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = 40    # одновременных соединений от Telegram к webhook
+# Сколько обновлений обрабатывается одновременно (1 — строго по очереди)
+CONCURRENT_UPDATES = 8
+# ---------------------------------------------------------------------------
+
+# Журнал работы бота пишет отдельный поток — обработчики не ждут диска или терминала.
+# LOG_FORMAT: "text" — строки как раньше, "json" — одна JSON-строка на запись (для сборщиков логов).
+LOG_FORMAT = "text"
+LOG_FILE = ""                   # пусто — вывод в stderr
+# Уровни по подсистемам: "" — бот и всё, что не указано отдельно; "monitor" — уведомления о сроках,
+# "storage" — запись данных, "sender" — отправка в Telegram, "httpx" — каждый запрос к Bot API
+LOG_LEVELS = {"": "INFO", "monitor": "INFO", "storage": "INFO", "sender": "INFO", "httpx": "WARNING"}
+# Строк об уведомлениях по отдельным формам — не больше стольких в минуту (0 — все)
+LOG_MONITOR_SAMPLE = 30
+
 logger = logging.getLogger(__name__)
+monitor_logger = logging.getLogger("monitor")
 
 # Файлы для сохранения данных
 FORMS_FILE = "active_forms.json"       # Активные формы
 KNOWN_CHATS_FILE = "known_chats.json"  # Известные чаты
 JOURNAL_FILE = "journal_forms.json"    # Журнал всех форм
+WAL_FILE = "forms_wal.jsonl"           # Журнал изменений форм (дописывается построчно)
+STATS_FILE = "stats.json"              # Накопительная статистика для /stats
+
+# После скольких операций журнал изменений сжимается в снимки FORMS_FILE и JOURNAL_FILE
+WAL_COMPACT_EVERY = 500
+
+# Формат снимков FORMS_FILE и JOURNAL_FILE: "json" — компактный JSON (быстрее с orjson),
+# "msgpack" — двоичный, меньше и быстрее (нужен пакет msgpack). Формат можно сменить в любой момент:
+# снимки читаются в любом формате, включая старые файлы с отступами.
+SNAPSHOT_FORMAT = "json"
+
+# В JOURNAL_FILE остаются только формы текущего месяца (по дате выхода) и активные формы,
+# остальные при сжатии переносятся в сжатые помесячные сегменты в JOURNAL_ARCHIVE_DIR
+JOURNAL_ARCHIVE_DIR = "journal_archive"
+# Сколько последних месяцев архива журнала хранить (0 — хранить всё)
+JOURNAL_RETENTION_MONTHS = 0
+
+# Хранилище данных: "json" — файлы выше, "sqlite" — база SQLITE_FILE.
+# При первом запуске с "sqlite" данные из JSON-файлов переносятся в базу автоматически.
+STORAGE_BACKEND = "json"
+SQLITE_FILE = "cavesmonitor.db"
+
+# Несколько экземпляров бота с общей базой SQLite (нужны STORAGE_BACKEND = "sqlite"
+# и UPDATE_MODE = "webhook" за балансировщиком: при polling Telegram отдаёт обновления одному процессу).
+# Обновления обрабатывают все экземпляры, а проверку сроков и сводку отправляет только тот,
+# кто держит аренду в базе. Аренда продлевается каждые LEASE_RENEW_INTERVAL секунд;
+# если экземпляр упал, другой забирает её не позже чем через LEASE_TTL секунд.
+MULTI_INSTANCE = False
+LEASE_TTL = 30
+LEASE_RENEW_INTERVAL = 10
+
+# Метрики в формате Prometheus: http://METRICS_LISTEN:METRICS_PORT/metrics (0 — не запускать)
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT = 9108
+
+# Табло «кто под землёй»: закреплённое сообщение в каждом чате из STATUS_BOARD_CHATS. Оно правится
+# на месте при изменении набора активных форм, не чаще раза в STATUS_BOARD_DEBOUNCE секунд;
+# длинный список делится на несколько сообщений. Пустой список — вместо табло сводка раз в 4 часа.
+STATUS_BOARD_CHATS = [ALARM_CHAT_ID]
+STATUS_BOARD_DEBOUNCE = 10
+STATUS_BOARD_FILE = "status_board.json"  # id сообщений табло и их текст
+# Длина одного сообщения табло — с запасом до лимита Telegram в 4096 символов (он считается в UTF-16)
+STATUS_BOARD_PAGE_SIZE = 4000
 
 TZ_LOCAL = timezone(timedelta(hours=3))
 
-# Глобовый словарь активных форм.
+# Глобовый словарь активных форм {form_id: FormRecord}.
 active_forms = {}
 
-# Глобовый список всех форм (журнал).
+# Индексы активных форм: user_id -> {form_id} и система (casefold) -> {form_id}
+forms_by_user = {}
+forms_by_system = {}
+
+# Сколько активных форм одновременно может быть у одного пользователя (руководитель нескольких групп)
+MAX_ACTIVE_FORMS_PER_USER = 10
+
+# Стадии уведомлений о незакрытой форме. Стадия срабатывает через offset минут после срока
+# after ("exit" — время выхода, "control" — контрольное время) и, если repeat > 0, повторяется
+# каждые repeat минут, всего не больше times раз (0 — пока форма не закрыта).
+# chats — куда отправлять: "alarm", "form" или id чата (например, дежурных спасателей);
+# в чатах с отчётом формы уведомление отправляется ответом на него.
+# В тексте доступны {user}, {system}, {date_up}, {time_up}, {control} и {overdue} — сколько прошло после срока.
+# flag — прежняя отметка формы, в которой хранится состояние стадий exit и control.
+ESCALATION_STAGES = [
+    {"name": "exit", "after": "exit", "offset": 0, "chats": ["alarm"], "flag": "not_exited_notified",
+     "text": "🚨 {user} не вышел к назначенному времени (было: {date_up} {time_up})."},
+    {"name": "control", "after": "control", "offset": 0, "chats": ["alarm"], "flag": "alarm_notified",
+     "text": "🔥 Аларм! {user} задержался сверх контрольного времени (было: {date_up} {control})."},
+    {"name": "reminder", "after": "control", "offset": 60, "repeat": 60, "times": 12, "chats": ["alarm"],
+     "text": "⏰ {user} всё ещё не вышел: контрольное время прошло {overdue} назад (система: {system})."},
+    # {"name": "escalation", "after": "control", "offset": 180, "chats": [-1001234567890],
+    #  "text": "🆘 {user} не вышел через {overdue} после контрольного времени "
+    #          "(система: {system}, контроль: {date_up} {control})."},
+]
+STAGES_BY_NAME = {stage["name"]: stage for stage in ESCALATION_STAGES}
+# Отметка, которая добавляется к отчётам и уведомлениям формы при выходе
+EXIT_MARK = "\n\n✅ Пользователь вышел."
+
+# Глобовый список форм журнала текущего месяца, элементы — FormRecord.
+# Более старые записи — в архиве journal_archive.
 journal_forms = []
+journal_archive = JournalArchive(JOURNAL_ARCHIVE_DIR)
+# Индекс записей journal_forms по form_id: отметки о выходе и уведомлениях без поиска по списку
+journal_index = {}
+# Месяц (YYYY-MM), по который journal_forms разобран при последнем сжатии
+journal_hot_month = None
+# Журнал прочитан. При запуске читается только состояние активных форм, журнал — следом
+# за рассылкой пропущенных уведомлений или при первом обращении (ensure_journal)
+journal_loaded = False
+# Фоновая загрузка журнала (load_journal_async), пока она идёт
+journal_load_task = None
+# Операции журнала изменений, записанные во время фоновой загрузки журнала (иначе None)
+journal_backlog = None
+# Записи, убранные из journal_forms при сжатии, но ещё не записанные в архив: месяц -> [FormRecord].
+# Запись сжатия, вытесненная из очереди следующей (тот же ключ "compact"), не теряет их:
+# архивирует всё, что здесь накопилось к моменту записи, и убирает записанное
+pending_archive = {}
+pending_archive_lock = threading.Lock()
 
 # Глобовый словарь известных чатов {chat_id: chat_title}
 known_chats = {}
 
+# Накопительная статистика (/count, /stats), обновляется по событиям форм
+stats = FormStats()
+# MULTI_INSTANCE: приращения статистики, взятые из stats, но ещё не прибавленные к записи в базе
+# (их забирает поток записи, поэтому — под stats_changes_lock)
+stats_changes = FormStats()
+stats_changes_lock = threading.Lock()
+
+# Сколько последних месяцев показывать в /stats
+STATS_MONTHS = 6
+
+# Отметки об уведомлениях и статистика пишутся отложенно: одной пачкой за проход
+# мониторинга или не позже чем через PERSIST_DEBOUNCE секунд после изменения
+PERSIST_DEBOUNCE = 2
+# Изменённые, но ещё не записанные отметки: (form_id, поле) -> значение
+pending_flags = {}
+stats_dirty = False
+persist_job = None
+
+# Поток записи файлов данных: обработчики только ставят запись в очередь
+persistence = PersistenceWorker()
+
+# Журнал изменений active_forms и journal_forms
+wal = WriteAheadLog(WAL_FILE, persistence)
+
+# База SQLite, если STORAGE_BACKEND == "sqlite" (иначе None)
+db = None
+
+# Отправка сообщений с учётом лимитов Telegram
+sender = SendDispatcher()
+
+# Пользователи, чья форма сейчас отправляется (защита от двойной отправки при параллельной обработке)
+submitting_users = set()
+
+# Версия набора активных форм и готовые строки списков {вид: (версия, строки)}
+active_forms_version = 0
+rendered_active_lines = {}
+
+# Сообщения табло по чатам: {str(chat_id): {"message_ids": [...], "texts": [...]}}
+# и задача JobQueue, которая обновит табло
+status_board = {}
+status_board_job = None
+
+# Обратный индекс сообщений-отчётов: (chat_id, message_id) -> form_id
+report_index = {}
+
+# Очередь сроков уведомлений: куча из (момент UTC, form_id, имя стадии из ESCALATION_STAGES).
+# У каждой формы в очереди не больше одного срока на стадию — следующий ставится после отправки.
+deadline_queue = []
+
+# Задача JobQueue, которая проснётся к ближайшему сроку, и момент её запуска
+deadline_job = None
+deadline_job_at = None
+# Проход мониторинга и перечитывание общей базы (MULTI_INSTANCE) не идут одновременно:
+# пока уведомления прохода отправляются, их стадии ещё не отмечены, и перечитанная
+# очередь сроков поставила бы их повторно
+monitor_lock = asyncio.Lock()
+
+# Имя аренды мониторинга в базе, идентификатор этого процесса и держит ли он аренду.
+# В обычном (одиночном) режиме процесс всегда ведущий.
+MONITOR_LEASE = "monitor"
+instance_id = f"{socket.gethostname()}:{os.getpid()}"
+is_leader = not MULTI_INSTANCE
+# С какого момента этот процесс следит за сроками: запуск или захват аренды (MULTI_INSTANCE).
+# Срок раньше этого момента у формы, отправленной тоже раньше, пропущен за время простоя:
+# такие уведомления отправляются по одному в порядке сроков с пометкой о задержке
+monitor_started_at = datetime.datetime.now(timezone.utc)
+
 def load_forms():
+    """
+    Загрузка снимка активных форм и повтор операций из журнала изменений.
+    Старые файлы и записи лога хранят формы по id пользователя — такие ключи
+    заменяются на form_id (у пользователя тогда могла быть только одна форма).
+    """
     global active_forms
-    if os.path.exists(FORMS_FILE):
-        try:
-            with open(FORMS_FILE, "r", encoding="utf-8") as f:
-                active_forms = json.load(f)
-            logger.info("Формы успешно загружены из файла.")
-        except Exception as e:
-            logger.error(f"Ошибка загрузки форм: {e}")
+    try:
+        if db is not None:
             active_forms = {}
-    else:
+            rekeyed = []
+            for key, data in db.load_active().items():
+                form = FormRecord.from_dict(data)
+                active_forms[form.form_id] = form
+                if key != form.form_id:
+                    rekeyed.append((key, form.form_id))
+            if rekeyed:
+                db.rekey_active(rekeyed)
+            logger.info("Формы успешно загружены из базы.")
+        else:
+            forms_data, snapshot_seq = read_snapshot(FORMS_FILE, "forms", {})
+            active_forms = {}
+            # Ключ в файле или в записи лога -> form_id
+            keys = {}
+            for key, data in forms_data.items():
+                form = FormRecord.from_dict(data)
+                active_forms[form.form_id] = form
+                keys[key] = form.form_id
+            wal.seq = max(wal.seq, snapshot_seq)
+            for entry in wal.replay():
+                if entry["seq"] <= snapshot_seq:
+                    continue
+                op = entry["op"]
+                if op == "create":
+                    form = FormRecord.from_dict(entry["record"])
+                    active_forms[form.form_id] = form
+                    keys[entry.get("uid", form.form_id)] = form.form_id
+                    continue
+                form_id = entry.get("form_id") or keys.get(entry.get("uid"))
+                if op == "exit":
+                    active_forms.pop(form_id, None)
+                elif op == "flag" and form_id in active_forms:
+                    setattr(active_forms[form_id], entry["field"], entry["value"])
+            logger.info("Формы успешно загружены из файла.")
+    except Exception as e:
+        logger.error(f"Ошибка загрузки форм: {e}")
         active_forms = {}
+    reindex_active_forms()
+
+def system_key(system) -> str:
+    return system.casefold() if system else ""
+
+def add_active_form(form: FormRecord):
+    """Добавление активной формы во все индексы."""
+    active_forms[form.form_id] = form
+    forms_by_user.setdefault(form.user_id, set()).add(form.form_id)
+    forms_by_system.setdefault(system_key(form.system), set()).add(form.form_id)
+    index_form_reports(form)
+
+def remove_active_form(form_id: str) -> FormRecord:
+    """Удаление активной формы из всех индексов. Возвращает форму или None."""
+    form = active_forms.pop(form_id, None)
+    if form is None:
+        return None
+    for index, key in ((forms_by_user, form.user_id), (forms_by_system, system_key(form.system))):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(form_id)
+            if not ids:
+                del index[key]
+    unindex_form_reports(form)
+    return form
+
+def reindex_active_forms():
+    """Перестроение индексов после замены набора активных форм."""
+    report_index.clear()
+    forms_by_user.clear()
+    forms_by_system.clear()
+    for form in list(active_forms.values()):
+        add_active_form(form)
+    mark_active_forms_changed()
+
+async def run_db(func, *args):
+    """
+    Запрос к базе в пуле потоков: соединение общее с потоком записи, а с несколькими процессами
+    ожидание блокировки базы доходит до секунд — цикл событий в это время не ждёт.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+async def user_active_forms(user_id: int) -> list:
+    """Активные формы пользователя (O(k) по его формам; с MULTI_INSTANCE — и созданные другими процессами)."""
+    shared = await run_db(db.active_for_user, user_id) if MULTI_INSTANCE else []
+    forms = {form_id: active_forms[form_id] for form_id in forms_by_user.get(user_id, ())}
+    for data in shared:
+        form = FormRecord.from_dict(data)
+        forms.setdefault(form.form_id, form)
+    return list(forms.values())
+
+async def reload_shared_state():
+    """
+    Перечитывание активных форм из общей базы (MULTI_INSTANCE): формы создают
+    и закрывают все экземпляры. Сначала дописываем в базу свою очередь записи.
+    """
+    global active_forms, stats
+    before = set(active_forms)
+    flush_pending_changes()
+    await asyncio.get_running_loop().run_in_executor(None, persistence.flush)
+
+    def read():
+        forms = [FormRecord.from_dict(data) for data in db.load_active().values()]
+        return forms, db.load_known_chats(), db.load_stats("forms")
 
-def save_forms():
     try:
-        with open(FORMS_FILE, "w", encoding="utf-8") as f:
-            json.dump(active_forms, f, ensure_ascii=False, indent=4, default=str)
+        forms, chats, stats_data = await run_db(read)
+    except Exception as e:
+        logger.error(f"Ошибка чтения активных форм из базы: {e}")
+        return
+    # Формы, созданные или закрытые здесь во время чтения, в прочитанное могли не попасть
+    closed = before - set(active_forms)
+    created = [form for form_id, form in active_forms.items() if form_id not in before]
+    active_forms = {form.form_id: form for form in forms if form.form_id not in closed}
+    for form in created:
+        active_forms.setdefault(form.form_id, form)
+    known_chats.update(chats)
+    reindex_active_forms()
+    build_deadline_queue()
+    if stats_data is not None and stats.changes is not None:
+        # Счётчики других экземпляров — из базы, плюс ещё не записанные приращения этого
+        shared = FormStats.from_dict(stats_data)
+        with stats_changes_lock:
+            shared.merge(stats_changes.to_dict())
+        shared.merge(stats.changes.to_dict())
+        shared.changes = stats.changes
+        stats = shared
+    stats.reset_active(form.system for form in active_forms.values())
+
+async def hold_monitor_lease() -> bool:
+    """Захват или продление аренды мониторинга. Возвращает True, если этот процесс ведущий."""
+    global is_leader, monitor_started_at, status_board
+    if not MULTI_INSTANCE:
+        return True
+    try:
+        leader = await run_db(db.acquire_lease, MONITOR_LEASE, instance_id, LEASE_TTL)
+    except Exception as e:
+        logger.error(f"Ошибка продления аренды мониторинга: {e}")
+        leader = False
+    if leader and not is_leader:
+        monitor_started_at = datetime.datetime.now(timezone.utc)
+        # Табло вёл прежний ведущий: правим его сообщения, а не отправляем и закрепляем второе табло
+        status_board = await run_db(read_status_board)
+        logger.info(f"Экземпляр {instance_id} стал ведущим: мониторинг сроков и сводка работают здесь.")
+    elif is_leader and not leader:
+        logger.warning(f"Экземпляр {instance_id} потерял аренду мониторинга.")
+    is_leader = leader
+    return leader
+
+async def maintain_monitor_lease(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Периодическое продление аренды и синхронизация активных форм с базой.
+    Новый ведущий сразу планирует проверку сроков, включая уже пропущенные.
+    """
+    global deadline_job
+    leader = await hold_monitor_lease()
+    if not monitor_lock.locked():
+        async with monitor_lock:
+            await reload_shared_state()
+    # Иначе идёт проход мониторинга: он сам перечитывает базу в начале
+    if leader:
+        schedule_deadline_check(context.job_queue)
+        # Формы могли добавить или закрыть другие экземпляры
+        schedule_status_board(context.job_queue)
+    elif deadline_job is not None:
+        deadline_job.schedule_removal()
+        deadline_job = None
+
+def save_forms(forms: dict, wal_seq: int):
+    try:
+        data = {form_id: form.to_dict() for form_id, form in forms.items()}
+        write_snapshot(FORMS_FILE, "forms", data, wal_seq, SNAPSHOT_FORMAT)
     except Exception as e:
         logger.error(f"Ошибка сохранения форм: {e}")
+        raise
 
 def load_known_chats():
     global known_chats
-    if os.path.exists(KNOWN_CHATS_FILE):
+    if db is not None:
+        known_chats = db.load_known_chats()
+    elif os.path.exists(KNOWN_CHATS_FILE):
         try:
             with open(KNOWN_CHATS_FILE, "r", encoding="utf-8") as f:
                 known_chats = json.load(f)
@@ -104,31 +471,592 @@ def load_known_chats():
         known_chats = {}
 
 def save_known_chats():
+    chats = dict(known_chats)
+
+    def write():
+        try:
+            if db is not None:
+                db.save_known_chats(chats)
+            else:
+                atomic_write_json(KNOWN_CHATS_FILE, chats, indent=4)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения KNOWN_CHATS_FILE: {e}")
+
+    persistence.write("known_chats", write)
+
+def load_status_board():
+    """Сообщения табло, отправленные до перезапуска: после него они правятся, а не отправляются заново."""
+    global status_board
+    status_board = read_status_board()
+
+def read_status_board() -> dict:
     try:
-        with open(KNOWN_CHATS_FILE, "w", encoding="utf-8") as f:
-            json.dump(known_chats, f, ensure_ascii=False, indent=4)
+        if db is not None:
+            data = db.load_stats("status_board")
+        elif os.path.exists(STATUS_BOARD_FILE):
+            with open(STATUS_BOARD_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        else:
+            data = None
     except Exception as e:
-        logger.error(f"Ошибка сохранения KNOWN_CHATS_FILE: {e}")
+        logger.error(f"Ошибка загрузки табло: {e}")
+        data = None
+    return data or {}
 
-def load_journal():
-    global journal_forms
-    if os.path.exists(JOURNAL_FILE):
+def save_status_board():
+    data = {chat: {"message_ids": list(state["message_ids"]), "texts": list(state["texts"])}
+            for chat, state in status_board.items()}
+
+    def write():
         try:
-            with open(JOURNAL_FILE, "r", encoding="utf-8") as f:
-                journal_forms = json.load(f)
-            logger.info("Журнал форм успешно загружен.")
+            if db is not None:
+                db.save_stats("status_board", data)
+            else:
+                atomic_write_json(STATUS_BOARD_FILE, data, indent=4)
         except Exception as e:
-            logger.error(f"Ошибка загрузки журнала форм: {e}")
-            journal_forms = []
+            logger.error(f"Ошибка сохранения табло: {e}")
+
+    persistence.write("status_board", write)
+
+def load_stats():
+    """Загрузка статистики; если она ещё не сохранялась — однократный подсчёт по журналу."""
+    global stats
+    try:
+        if db is not None:
+            data = db.load_stats("forms")
+        elif os.path.exists(STATS_FILE):
+            with open(STATS_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        else:
+            data = None
+    except Exception as e:
+        logger.error(f"Ошибка загрузки статистики: {e}")
+        data = None
+    if data is not None:
+        stats = FormStats.from_dict(data)
+        # Активные формы могли измениться после последней записи статистики (сбой) — считаем по факту
+        stats.reset_active(form.system for form in active_forms.values())
+    else:
+        rebuild_stats()
+        save_stats()
+        logger.info("Статистика подсчитана по журналу форм.")
+    if MULTI_INSTANCE:
+        # Счётчики ведут все процессы: дальше в базу прибавляются только приращения (save_stats)
+        stats.track_changes()
+
+def rebuild_stats():
+    """Подсчёт статистики по всему журналу (время фактического выхода в старых записях неизвестно)."""
+    global stats
+    stats = FormStats()
+    if db is not None:
+        records = (FormRecord.from_dict(data) for data in db.iter_journal())
     else:
+        # Вызывается при запуске, до цикла событий
+        if not journal_loaded:
+            load_journal()
+        records = itertools.chain(
+            (FormRecord.from_dict(data) for data in journal_archive.iter_records()),
+            pending_archive_records(),
+            journal_forms
+        )
+    for record in records:
+        stats.add_trip(record.system, journal_month(record))
+        if record.not_exited_notified:
+            stats.add_alert("exit")
+        if record.alarm_notified:
+            stats.add_alert("control")
+    stats.reset_active(form.system for form in active_forms.values())
+
+def save_stats():
+    if stats.changes is not None:
+        save_stats_changes()
+        return
+    data = stats.to_dict()
+
+    def write():
+        try:
+            if db is not None:
+                db.save_stats("forms", data)
+            else:
+                atomic_write_json(STATS_FILE, data, indent=4)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения статистики: {e}")
+
+    persistence.write("stats", write)
+
+def save_stats_changes():
+    """
+    Статистика в общей базе (MULTI_INSTANCE): к записи прибавляются приращения этого процесса,
+    перезапись целиком потеряла бы счётчики других экземпляров.
+    """
+    with stats_changes_lock:
+        stats_changes.merge(stats.take_changes())
+
+    def write():
+        global stats_changes
+        with stats_changes_lock:
+            changes, stats_changes = stats_changes, FormStats()
+        delta = changes.to_dict()
+
+        def add(data):
+            total = FormStats.from_dict(data or {})
+            total.merge(delta)
+            return total.to_dict()
+
+        try:
+            db.update_stats("forms", add)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения статистики: {e}")
+            # Приращения не потеряются: их прибавит следующая запись
+            with stats_changes_lock:
+                stats_changes.merge(delta)
+
+    # Задача берёт приращения в момент записи, поэтому замена в очереди ничего не теряет
+    persistence.write("stats", write)
+
+def apply_journal_entry(records: list, index: dict, entry: dict):
+    """Повтор одной операции журнала изменений над записями журнала."""
+    op = entry["op"]
+    if op == "create":
+        record = FormRecord.from_dict(entry["record"])
+        records.append(record)
+        index[record.form_id] = record
+        return
+    record = index.get(entry.get("form_id"))
+    if record is None:
+        # Старые записи лога без form_id
+        return
+    if op == "exit":
+        record.exited_at = datetime.datetime.fromtimestamp(entry["ts"], timezone.utc) if entry.get("ts") else None
+    elif op == "flag":
+        setattr(record, entry["field"], entry["value"])
+
+def read_journal():
+    """
+    Чтение снимка журнала и повтор журнала изменений без изменения глобального состояния
+    (выполняется и в пуле потоков). Возвращает (записи, индекс, номер операции снимка,
+    номер последней повторённой операции).
+    """
+    journal_data, snapshot_seq = read_snapshot(JOURNAL_FILE, "journal", [])
+    records = [FormRecord.from_dict(data) for data in journal_data]
+    index = {record.form_id: record for record in records}
+    last_seq = snapshot_seq
+    for entry in wal.entries():
+        if entry["seq"] <= snapshot_seq:
+            continue
+        apply_journal_entry(records, index, entry)
+        last_seq = entry["seq"]
+    return records, index, snapshot_seq, last_seq
+
+def install_journal(records: list, index: dict):
+    """Подстановка прочитанного журнала."""
+    global journal_forms, journal_loaded
+    # Активная форма и её запись журнала — один объект, как и до перезапуска (один проход при запуске)
+    if active_forms:
+        for i, record in enumerate(records):
+            form = active_forms.get(record.form_id)
+            if form is not None:
+                records[i] = form
+                index[form.form_id] = form
+    journal_forms = records
+    journal_index.clear()
+    journal_index.update(index)
+    journal_loaded = True
+
+def load_journal():
+    """Загрузка снимка журнала и дописывание форм, созданных после него (до запуска цикла событий)."""
+    global journal_forms, journal_loaded
+    if db is not None:
+        # Журнал остаётся в базе и читается /journal по запросу
         journal_forms = []
+        journal_index.clear()
+        journal_loaded = True
+        return
+    try:
+        records, index, snapshot_seq, _ = read_journal()
+        wal.seq = max(wal.seq, snapshot_seq)
+        logger.info("Журнал форм успешно загружен.")
+    except Exception as e:
+        logger.error(f"Ошибка загрузки журнала форм: {e}")
+        records, index = [], {}
+    install_journal(records, index)
 
-def save_journal():
+async def load_journal_async():
+    """
+    Загрузка журнала после запуска: запись очереди, чтение и разбор файлов — в пуле потоков,
+    цикл событий в это время обрабатывает обновления. Операции, записанные в журнал изменений
+    за время чтения, собираются в journal_backlog и повторяются перед подстановкой.
+    """
+    global journal_backlog, journal_load_task
+    if db is not None:
+        load_journal()
+        journal_load_task = None
+        return
+    loop = asyncio.get_running_loop()
+    journal_backlog = []
     try:
-        with open(JOURNAL_FILE, "w", encoding="utf-8") as f:
-            json.dump(journal_forms, f, ensure_ascii=False, indent=4, default=str)
+        # Всё, что поставлено в очередь до начала загрузки, — на диск; более позднее есть в journal_backlog
+        await loop.run_in_executor(None, persistence.flush)
+        records, index, snapshot_seq, last_seq = await loop.run_in_executor(None, read_journal)
+    except Exception as e:
+        # Журнал не подставляется: сжатие не запишет пустой снимок, загрузка повторится при следующем обращении
+        logger.error(f"Ошибка загрузки журнала форм: {e}")
+        return
+    finally:
+        backlog = journal_backlog
+        journal_backlog = None
+        journal_load_task = None
+    for entry in backlog:
+        if entry["seq"] > last_seq:
+            apply_journal_entry(records, index, entry)
+    wal.seq = max(wal.seq, snapshot_seq)
+    install_journal(records, index)
+    logger.info("Журнал форм успешно загружен.")
+    # Сжатие, отложенное до загрузки журнала
+    if wal.pending >= WAL_COMPACT_EVERY or journal_hot_month != current_month():
+        compact_storage()
+
+def start_journal_load() -> asyncio.Task:
+    """Запуск фоновой загрузки журнала, если она ещё не идёт."""
+    global journal_load_task
+    if journal_load_task is None:
+        journal_load_task = asyncio.get_running_loop().create_task(load_journal_async())
+    return journal_load_task
+
+async def ensure_journal():
+    """Загрузка журнала при первом обращении без блокировки цикла событий."""
+    if journal_loaded:
+        return
+    await asyncio.shield(start_journal_load())
+
+async def warm_up_journal(context: ContextTypes.DEFAULT_TYPE):
+    """Чтение журнала после запуска, когда срочные уведомления уже в работе; сжатие — по его окончании."""
+    await ensure_journal()
+
+def save_journal(records: list, wal_seq: int):
+    try:
+        data = [record.to_dict() for record in records]
+        write_snapshot(JOURNAL_FILE, "journal", data, wal_seq, SNAPSHOT_FORMAT)
     except Exception as e:
         logger.error(f"Ошибка сохранения журнала форм: {e}")
+        raise
+
+def current_month() -> str:
+    return datetime.datetime.now(TZ_LOCAL).strftime("%Y-%m")
+
+def shift_month(month: str, delta: int) -> str:
+    """Месяц YYYY-MM, сдвинутый на delta месяцев."""
+    index = int(month[:4]) * 12 + int(month[5:7]) - 1 + delta
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+def journal_month(record: FormRecord) -> str:
+    """Месяц сегмента архива для записи: по дате выхода, если она задана, иначе по времени заполнения."""
+    date_up = record.date_up or ""
+    if len(date_up) >= 7 and date_up[:4].isdigit() and date_up[4] == "-" and date_up[5:7].isdigit():
+        return date_up[:7]
+    if record.filled_at is not None:
+        return record.filled_at.astimezone(TZ_LOCAL).strftime("%Y-%m")
+    return current_month()
+
+def compact_storage():
+    """
+    Сжатие журнала изменений: пишем полные снимки форм и журнала,
+    после чего лог можно очистить. Если запись снимка не удалась, лог остаётся.
+    Записи журнала прошлых месяцев (кроме ещё активных форм) уходят в архив,
+    в снимке журнала остаются только текущие.
+    Здесь фиксируется только состояние (копия словаря форм и длина журнала),
+    сериализация и запись выполняются в потоке записи.
+    """
+    global journal_forms, journal_hot_month
+    if not journal_loaded:
+        # Без журнала снимок журнала не записать: сжатие выполнит фоновая загрузка по окончании
+        start_journal_load()
+        return
+    month = current_month()
+    archived = {}
+    hot = []
+    for record in journal_forms:
+        record_month = journal_month(record)
+        if record_month < month and record.form_id not in active_forms:
+            archived.setdefault(record_month, []).append(record)
+        else:
+            hot.append(record)
+    if archived:
+        journal_forms = hot
+        with pending_archive_lock:
+            for record_month, records in archived.items():
+                pending_archive.setdefault(record_month, []).extend(records)
+        for records in archived.values():
+            for record in records:
+                journal_index.pop(record.form_id, None)
+    journal_hot_month = month
+    forms = dict(active_forms)
+    journal = journal_forms
+    journal_end = len(journal_forms)
+    wal_seq = wal.seq
+    retain_from = shift_month(month, -JOURNAL_RETENTION_MONTHS + 1) if JOURNAL_RETENTION_MONTHS else None
+
+    def write():
+        with pending_archive_lock:
+            to_archive = {record_month: list(records) for record_month, records in pending_archive.items()}
+        try:
+            # Сначала архив: если снимок не запишется, записи останутся и в старом снимке,
+            # а повторный перенос их не продублирует
+            for record_month, records in sorted(to_archive.items()):
+                journal_archive.add(record_month, [record.to_dict() for record in records])
+            if to_archive:
+                logger.info(f"В архив журнала перенесено записей: {sum(map(len, to_archive.values()))}.")
+            with pending_archive_lock:
+                for record_month, records in to_archive.items():
+                    written = set(map(id, records))
+                    left = [record for record in pending_archive.get(record_month, []) if id(record) not in written]
+                    if left:
+                        pending_archive[record_month] = left
+                    else:
+                        pending_archive.pop(record_month, None)
+            if retain_from:
+                for dropped in journal_archive.drop_before(retain_from):
+                    logger.info(f"Удалён сегмент архива журнала за {dropped}.")
+            save_forms(forms, wal_seq)
+            save_journal(journal[:journal_end], wal_seq)
+        except Exception as e:
+            logger.error(f"Ошибка сжатия журнала изменений: {e}")
+            return
+        wal.truncate()
+        logger.info("Журнал изменений сжат в снимки.")
+
+    wal.pending = 0
+    persistence.write("compact", write)
+
+def pending_archive_records(month_from: str = None, month_to: str = None) -> list:
+    """Записи, ожидающие переноса в архив, за месяцы в границах (включительно)."""
+    with pending_archive_lock:
+        return [
+            record
+            for record_month, records in sorted(pending_archive.items())
+            if (not month_from or record_month >= month_from) and (not month_to or record_month <= month_to)
+            for record in records
+        ]
+
+def log_change(op: str, **fields):
+    """Дозапись операции в журнал изменений и периодическое сжатие."""
+    if op != "flag" and pending_flags:
+        # Отложенные отметки пишутся раньше выхода или новой формы — порядок операций сохраняется
+        flush_pending_changes()
+    if db is not None:
+        persistence.append(db, {"op": op, **fields})
+        return
+    try:
+        seq = wal.append(op, **fields)
+    except Exception as e:
+        logger.error(f"Ошибка записи в журнал изменений: {e}")
+        return
+    if journal_backlog is not None:
+        journal_backlog.append({"seq": seq, "op": op, **fields})
+    # Сжатие и после смены месяца — чтобы журнал прошлого месяца ушёл в архив
+    if wal.pending >= WAL_COMPACT_EVERY or journal_hot_month != current_month():
+        compact_storage()
+
+def mark_flag(form: FormRecord, field: str, value):
+    """Изменение отметки формы с отложенной записью (см. flush_pending_changes)."""
+    update_journal_entry(form, **{field: value})
+    pending_flags[(form.form_id, field)] = value
+
+def mark_stats_dirty(job_queue=None):
+    """Статистика изменилась; запись — через PERSIST_DEBOUNCE секунд (или с ближайшей пачкой)."""
+    global stats_dirty
+    stats_dirty = True
+    if job_queue is not None:
+        schedule_persist(job_queue)
+
+def schedule_persist(job_queue):
+    global persist_job
+    if persist_job is None:
+        persist_job = job_queue.run_once(persist_pending_changes, when=PERSIST_DEBOUNCE)
+
+async def persist_pending_changes(context: ContextTypes.DEFAULT_TYPE):
+    global persist_job
+    persist_job = None
+    flush_pending_changes()
+
+def flush_pending_changes():
+    """Запись всех отложенных отметок одной пачкой и статистики — одной записью."""
+    global stats_dirty
+    flags = list(pending_flags.items())
+    pending_flags.clear()
+    for (form_id, field), value in flags:
+        log_change("flag", form_id=form_id, field=field, value=value)
+    if stats_dirty:
+        stats_dirty = False
+        save_stats()
+
+async def on_shutdown(application):
+    """post_shutdown: запись отложенных изменений перед остановкой."""
+    flush_pending_changes()
+
+def open_storage():
+    """Подключение базы SQLite, если она выбрана, и однократный перенос в неё данных из JSON."""
+    global db, journal_forms
+    if STORAGE_BACKEND != "sqlite":
+        return
+    sqlite_db = SQLiteStorage(SQLITE_FILE)
+    json_files = [FORMS_FILE, JOURNAL_FILE, KNOWN_CHATS_FILE, WAL_FILE]
+    if sqlite_db.is_empty() and any(os.path.exists(path) for path in json_files):
+        # Пока db не задана, load_* читают JSON-файлы
+        load_forms()
+        load_journal()
+        load_known_chats()
+        journal = list(journal_archive.iter_records()) + [record.to_dict() for record in journal_forms]
+        sqlite_db.import_json(
+            {form_id: form.to_dict() for form_id, form in active_forms.items()},
+            journal,
+            known_chats
+        )
+        logger.info(f"Данные перенесены из JSON в {SQLITE_FILE}: "
+                    f"{len(active_forms)} активных форм, {len(journal)} записей журнала.")
+        # Дальше журнал только в базе — прочитанный для переноса в памяти не держим
+        journal_forms = []
+        journal_index.clear()
+    db = sqlite_db
+
+def update_journal_entry(form: FormRecord, **fields):
+    """
+    Отметка события (выход, уведомление) в форме и в её записи журнала.
+    Запись находится по form_id за O(1); обычно это тот же объект, что и форма.
+    """
+    for name, value in fields.items():
+        setattr(form, name, value)
+    record = journal_index.get(form.form_id)
+    if record is not None and record is not form:
+        for name, value in fields.items():
+            setattr(record, name, value)
+
+def index_form_reports(form: FormRecord):
+    """Добавление сообщений-отчётов формы в обратный индекс report_index."""
+    for key in form.report_pairs():
+        report_index[key] = form.form_id
+
+def unindex_form_reports(form: FormRecord):
+    """Удаление сообщений-отчётов формы из обратного индекса."""
+    for key in form.report_pairs():
+        if report_index.get(key) == form.form_id:
+            del report_index[key]
+
+def parse_form_deadlines(date_up_str: str, time_up_str: str, control_str: str):
+    """
+    Разбор сроков формы в локальном времени. Возвращает (время выхода, контрольное время).
+    Если контрольное время задано только как HH:MM и оно <= времени выхода,
+    считаем, что контроль — это следующий день.
+    """
+    local_exit_dt = datetime.datetime.strptime(
+        f"{date_up_str} {time_up_str}",
+        "%Y-%m-%d %H:%M"
+    ).replace(tzinfo=TZ_LOCAL)
+    try:
+        # control_str может быть "YYYY-MM-DD HH:MM"
+        local_control_dt = datetime.datetime.strptime(
+            control_str, "%Y-%m-%d %H:%M"
+        ).replace(tzinfo=TZ_LOCAL)
+    except ValueError:
+        # Иначе считаем, что там только "HH:MM"
+        local_control_dt = datetime.datetime.strptime(
+            f"{date_up_str} {control_str}",
+            "%Y-%m-%d %H:%M"
+        ).replace(tzinfo=TZ_LOCAL)
+        if local_control_dt <= local_exit_dt:
+            local_control_dt += datetime.timedelta(days=1)
+    return local_exit_dt, local_control_dt
+
+def push_form_deadlines(form: FormRecord):
+    """
+    Постановка сроков формы в очередь. Сроки разбираются один раз и хранятся
+    в форме (exit_at, control_at); для старых форм вычисляются здесь.
+    """
+    if form.exit_at is None or form.control_at is None:
+        try:
+            local_exit_dt, local_control_dt = parse_form_deadlines(form.date_up, form.time_up, form.control)
+        except Exception as e:
+            logger.error(f"Ошибка разбора сроков формы {form.form_id}: {e}")
+            return
+        form.exit_at = local_exit_dt.astimezone(timezone.utc)
+        form.control_at = local_control_dt.astimezone(timezone.utc)
+    for stage in ESCALATION_STAGES:
+        due_at = stage_due(form, stage)
+        if due_at is not None:
+            heapq.heappush(deadline_queue, (due_at, form.form_id, stage["name"]))
+
+def stage_base(form: FormRecord, stage: dict):
+    """Срок формы, от которого отсчитывается стадия: время выхода или контрольное время (UTC)."""
+    return form.exit_at if stage["after"] == "exit" else form.control_at
+
+def stage_time(form: FormRecord, stage: dict, index: int):
+    """Момент index-го срабатывания стадии (UTC)."""
+    return stage_base(form, stage) + timedelta(minutes=stage.get("offset", 0) + index * stage.get("repeat", 0))
+
+def stage_index(form: FormRecord, stage: dict) -> int:
+    """Номер следующего срабатывания стадии: сколько сроков стадии уже пройдено."""
+    index = form.escalation.get(stage["name"], 0)
+    if stage.get("flag") and getattr(form, stage["flag"]):
+        index = max(index, 1)
+    return index
+
+def stage_due(form: FormRecord, stage: dict):
+    """Следующий срок стадии или None, если стадия по форме завершена."""
+    index = stage_index(form, stage)
+    times = stage.get("times", 0) if stage.get("repeat") else 1
+    if times and index >= times:
+        return None
+    return stage_time(form, stage, index)
+
+def advance_stage(form: FormRecord, stage: dict, now: datetime.datetime):
+    """
+    Отметка отправленного уведомления стадии и постановка её следующего срока.
+    Повторы, пропущенные из-за простоя бота, не догоняются: следующий срок — после now.
+    """
+    index = stage_index(form, stage) + 1
+    repeat = stage.get("repeat", 0)
+    if repeat:
+        elapsed = (now - stage_time(form, stage, 0)).total_seconds()
+        index = max(index, int(elapsed // (repeat * 60)) + 1)
+    flag = stage.get("flag")
+    if flag and not getattr(form, flag):
+        mark_flag(form, flag, True)
+    if index > (1 if flag else 0):
+        mark_flag(form, "escalation", {**form.escalation, stage["name"]: index})
+    due_at = stage_due(form, stage)
+    if due_at is not None:
+        heapq.heappush(deadline_queue, (due_at, form.form_id, stage["name"]))
+
+def stage_chats(stage: dict) -> list:
+    chats = {"alarm": ALARM_CHAT_ID, "form": FORM_CHAT_ID}
+    return [chats.get(chat, chat) for chat in stage["chats"]]
+
+def format_overdue(seconds: float) -> str:
+    minutes = max(0, int(seconds // 60))
+    if minutes < 60:
+        return f"{minutes} мин"
+    return f"{minutes // 60} ч {minutes % 60:02d} мин"
+
+def build_deadline_queue():
+    """Построение очереди сроков по всем активным формам (при запуске)."""
+    deadline_queue.clear()
+    for form in active_forms.values():
+        push_form_deadlines(form)
+
+def schedule_deadline_check(job_queue):
+    """Планирование одного запуска monitor_exit_deadlines точно к ближайшему сроку."""
+    global deadline_job, deadline_job_at
+    if not deadline_queue:
+        return
+    next_at = deadline_queue[0][0]
+    if deadline_job is not None and deadline_job_at <= next_at:
+        # Уже запланирована проверка не позже нужного срока
+        return
+    if deadline_job is not None:
+        deadline_job.schedule_removal()
+    delay = max(0.0, (next_at - datetime.datetime.now(timezone.utc)).total_seconds())
+    deadline_job = job_queue.run_once(monitor_exit_deadlines, when=delay)
+    deadline_job_at = next_at
 
 def get_form_summary(form_data: dict) -> str:
     """Формирование отчёта по форме с использованием HTML-форматирования."""
@@ -149,22 +1077,31 @@ async def send_to_reports(context: ContextTypes.DEFAULT_TYPE, text: str, parse_m
     Отправка сообщений.
     Если alarm_only==True – отправляем сообщение в чат для алармов,
     иначе – в чат для форм.
+    В несколько чатов сообщения отправляются одновременно.
     """
-    msg_ids = []
     if alarm_only:
         destination_chats = [ALARM_CHAT_ID]
     else:
         destination_chats = [FORM_CHAT_ID]
-    for chat_id in destination_chats:
+    sent = await send_to_chats(context, destination_chats, text, parse_mode, reply_to_map)
+    return [msg_id for _, msg_id in sent]
+
+async def send_to_chats(context: ContextTypes.DEFAULT_TYPE, destination_chats: list, text: str,
+                        parse_mode=ParseMode.HTML, reply_to_map: dict = None) -> list:
+    """Одновременная отправка сообщения в несколько чатов; возвращает пары (chat_id, message_id) отправленных."""
+    async def send(chat_id):
         kwargs = {"parse_mode": parse_mode}
         if reply_to_map and (chat_id in reply_to_map):
             kwargs["reply_to_message_id"] = reply_to_map[chat_id]
         try:
-            msg = await context.bot.send_message(chat_id, text, **kwargs)
-            msg_ids.append(msg.message_id)
+            msg = await sender.send_message(context.bot, chat_id, text, **kwargs)
+            return msg.message_id
         except Exception as e:
             logger.error(f"Ошибка при отправке в чат {chat_id}: {e}")
-    return msg_ids
+            return None
+
+    results = await asyncio.gather(*(send(chat_id) for chat_id in destination_chats))
+    return [(chat_id, msg_id) for chat_id, msg_id in zip(destination_chats, results) if msg_id is not None]
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_type = update.effective_chat.type
@@ -198,121 +1135,129 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
     await update.message.reply_text("Нажмите кнопку ниже для заполнения формы:", reply_markup=reply_markup)
 
+@timed("web_app_data")
 async def web_app_data_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # Логируем полное обновление для отладки
-    logger.info("Получено обновление web_app_data: %s", update.to_dict())
+    # Полное обновление — только для отладки: to_dict() дорогой, поэтому без DEBUG не вызывается
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Получено обновление web_app_data: %s", update.to_dict())
     
     if update.message and update.message.web_app_data:
         user = update.effective_user
+        logger.info("Получена форма от пользователя %s", user.id)
 
-        if str(user.id) in active_forms:
-            await update.message.reply_text("У вас уже есть активная форма. Дождитесь завершения предыдущей записи.")
+        if user.id in submitting_users:
+            await update.message.reply_text("Предыдущая форма ещё отправляется. Дождитесь её завершения.")
             return
-
-        data_str = update.message.web_app_data.data
+        # Отметка — до проверки лимита: с MULTI_INSTANCE проверка ждёт базу
+        submitting_users.add(user.id)
         try:
-            form_data = json.loads(data_str)
-        except json.JSONDecodeError as e:
-            # Попытка исправить возможные проблемы с кодировкой
-            try:
-                data_str_fixed = data_str.encode("latin-1").decode("utf-8")
-                form_data = json.loads(data_str_fixed)
-            except Exception as e2:
-                await update.message.reply_text("Ошибка обработки данных формы.")
-                logger.error(f"Ошибка загрузки данных формы: {e2}")
+            if len(await user_active_forms(user.id)) >= MAX_ACTIVE_FORMS_PER_USER:
+                await update.message.reply_text(
+                    f"У вас уже {MAX_ACTIVE_FORMS_PER_USER} активных форм. Закройте одну из них, прежде чем заполнять новую."
+                )
                 return
-        except Exception as e:
+            await submit_form(update, context, user)
+        finally:
+            submitting_users.discard(user.id)
+    else:
+        await update.message.reply_text("Нет данных веб‑приложения.")
+
+async def submit_form(update: Update, context: ContextTypes.DEFAULT_TYPE, user) -> None:
+    """Разбор данных веб-приложения, отправка отчётов и сохранение формы."""
+    data_str = update.message.web_app_data.data
+    try:
+        form_data = json.loads(data_str)
+    except json.JSONDecodeError as e:
+        # Попытка исправить возможные проблемы с кодировкой
+        try:
+            data_str_fixed = data_str.encode("latin-1").decode("utf-8")
+            form_data = json.loads(data_str_fixed)
+        except Exception as e2:
             await update.message.reply_text("Ошибка обработки данных формы.")
-            logger.error(f"Ошибка загрузки данных формы: {e}")
+            logger.error(f"Ошибка загрузки данных формы: {e2}")
             return
+    except Exception as e:
+        await update.message.reply_text("Ошибка обработки данных формы.")
+        logger.error(f"Ошибка загрузки данных формы: {e}")
+        return
 
-        if user.username:
-            username = f"@{user.username}"
-        else:
-            username = user.full_name
-        original_name = form_data.get("name", "—")
-        # Формируем имя с учётом username
-        form_data["name"] = f"{original_name} ({username})"
-        
-        #####################################################################
-        # ЕСЛИ КОНТРОЛЬНОЕ ВРЕМЯ (HH:MM) <= времени выхода, то увеличиваем дату на 1 день
-        # и записываем результат обратно в form_data["control"] в формате YYYY-MM-DD HH:MM.
-        #####################################################################
-        date_up_str = form_data.get("date_up")
-        time_up_str = form_data.get("time_up")
-        control_str = form_data.get("control")
-
-        if date_up_str and time_up_str and control_str:
-            try:
-                # Парсим дату/время выхода
-                local_exit_dt_local = datetime.datetime.strptime(
-                    f"{date_up_str} {time_up_str}",
-                    "%Y-%m-%d %H:%M"
-                ).replace(tzinfo=TZ_LOCAL)
-
-                # Пробуем понять, задан ли control сразу с датой (YYYY-MM-DD HH:MM) или только (HH:MM)
-                try:
-                    # Если control_str = "2025-02-21 12:00"
-                    local_control_dt_local = datetime.datetime.strptime(
-                        control_str, "%Y-%m-%d %H:%M"
-                    ).replace(tzinfo=TZ_LOCAL)
-                except ValueError:
-                    # Иначе считаем, что там только "HH:MM"
-                    temp_local_control = datetime.datetime.strptime(
-                        f"{date_up_str} {control_str}",
-                        "%Y-%m-%d %H:%M"
-                    ).replace(tzinfo=TZ_LOCAL)
-
-                    # Если контроль <= выхода, прибавляем сутки
-                    if temp_local_control <= local_exit_dt_local:
-                        temp_local_control += datetime.timedelta(days=1)
-
-                    local_control_dt_local = temp_local_control
-
-                # Формируем итоговую строку "YYYY-MM-DD HH:MM" для записи в form_data["control"]
-                corrected_str = local_control_dt_local.strftime("%Y-%m-%d %H:%M")
-                form_data["control"] = corrected_str
+    if user.username:
+        username = f"@{user.username}"
+    else:
+        username = user.full_name
+    original_name = form_data.get("name", "—")
+    # Формируем имя с учётом username
+    form_data["name"] = f"{original_name} ({username})"
+    
+    #####################################################################
+    # ЕСЛИ КОНТРОЛЬНОЕ ВРЕМЯ (HH:MM) <= времени выхода, то увеличиваем дату на 1 день
+    # и записываем результат обратно в form_data["control"] в формате YYYY-MM-DD HH:MM.
+    #####################################################################
+    date_up_str = form_data.get("date_up")
+    time_up_str = form_data.get("time_up")
+    control_str = form_data.get("control")
+
+    if date_up_str and time_up_str and control_str:
+        try:
+            _, local_control_dt_local = parse_form_deadlines(date_up_str, time_up_str, control_str)
+            # Формируем итоговую строку "YYYY-MM-DD HH:MM" для записи в form_data["control"]
+            corrected_str = local_control_dt_local.strftime("%Y-%m-%d %H:%M")
+            form_data["control"] = corrected_str
 
-            except Exception as e:
-                logger.warning(f"Ошибка вычисления контрольного времени: {e}")
-        #####################################################################
-
-        summary_text = get_form_summary(form_data)
-        # Отправляем отчёт с HTML‑форматированием в чат для форм и в чат для алармов
-        report_msg_ids_form = await send_to_reports(context, summary_text, parse_mode=ParseMode.HTML, alarm_only=False)
-        report_msg_ids_alarm = await send_to_reports(context, summary_text, parse_mode=ParseMode.HTML, alarm_only=True)
-        report_msg_ids = report_msg_ids_form + report_msg_ids_alarm
-        chat_ids = [FORM_CHAT_ID, ALARM_CHAT_ID]
-
-        # Сохраняем только необходимые данные для мониторинга
-        record = {
-            "report_msg_ids": report_msg_ids,
-            "chat_ids": chat_ids,
-            "date_up": form_data.get("date_up"),
-            "time_up": form_data.get("time_up"),
-            "control": form_data.get("control"),
-            "filled_at": datetime.datetime.utcnow().isoformat(),
-            "not_exited_notified": False,
-            "alarm_notified": False,
-            "user_id": user.id,
-            "username": username,
-            "system": form_data.get("system")
-        }
-        active_forms[str(user.id)] = record
-        save_forms()
-
-        # Добавляем запись в журнал всех форм
+        except Exception as e:
+            logger.warning(f"Ошибка вычисления контрольного времени: {e}")
+    #####################################################################
+
+    # Повторная отправка той же формы (те же система и время выхода) — по формам пользователя, без перебора всех
+    for form in await user_active_forms(user.id):
+        if (form.system, form.date_up, form.time_up) == (form_data.get("system"), form_data.get("date_up"), form_data.get("time_up")):
+            await update.message.reply_text("Такая форма уже активна (та же система и время выхода).")
+            return
+
+    summary_text = get_form_summary(form_data)
+    # Отправляем отчёт с HTML‑форматированием в чат для форм и в чат для алармов
+    report_msg_ids_form, report_msg_ids_alarm = await asyncio.gather(
+        send_to_reports(context, summary_text, parse_mode=ParseMode.HTML, alarm_only=False),
+        send_to_reports(context, summary_text, parse_mode=ParseMode.HTML, alarm_only=True)
+    )
+    report_msg_ids = report_msg_ids_form + report_msg_ids_alarm
+    # chat_ids должен совпадать по позициям с report_msg_ids, даже если одна из отправок не удалась
+    chat_ids = [FORM_CHAT_ID] * len(report_msg_ids_form) + [ALARM_CHAT_ID] * len(report_msg_ids_alarm)
+
+    # Сохраняем только необходимые данные для мониторинга
+    record = FormRecord(
+        user_id=user.id,
+        username=username,
+        system=form_data.get("system"),
+        date_up=form_data.get("date_up"),
+        time_up=form_data.get("time_up"),
+        control=form_data.get("control"),
+        filled_at=datetime.datetime.now(timezone.utc),
+        report_msg_ids=report_msg_ids,
+        chat_ids=chat_ids,
+        summary=summary_text,
+    )
+    add_active_form(record)
+    mark_active_forms_changed()
+    schedule_status_board(context.job_queue)
+    # Сроки разбираются один раз и сразу ставятся в очередь
+    push_form_deadlines(record)
+    schedule_deadline_check(context.job_queue)
+    # Добавляем запись в журнал всех форм (в режиме SQLite журнал только в базе)
+    if db is None:
         journal_forms.append(record)
-        save_journal()
+        journal_index[record.form_id] = record
+    log_change("create", form_id=record.form_id, record=record.to_dict())
+    stats.add_form(record.system, journal_month(record))
+    mark_stats_dirty(context.job_queue)
 
-        await update.message.reply_text("✅ Форма успешно отправлена!")
-    else:
-        await update.message.reply_text("Нет данных веб‑приложения.")
+    await update.message.reply_text("✅ Форма успешно отправлена!")
 
 async def test_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     await update.message.reply_text(f"Бот работает. ID чата: {chat_id} ✅")
 
+@timed("group_reply")
 async def group_reply_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Проверяем, что сообщение является ответом и его текст строго равен одному из нужных вариантов
     if update.message and update.message.reply_to_message and update.message.text:
@@ -324,88 +1269,217 @@ async def group_reply_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         reply_msg = update.message.reply_to_message
         attempt_user_id = update.effective_user.id
 
-        for uid, form in list(active_forms.items()):
-            if reply_msg.message_id in form.get("report_msg_ids", []):
-                # Разрешаем удалять форму, если это автор формы ИЛИ пользователь в ADMIN_USERS
-                if (int(uid) == attempt_user_id) or (attempt_user_id in ADMIN_USERS):
-                    del active_forms[uid]
-                    save_forms()
-                    await update.message.reply_text("👍 Форма удалена (статус: вышел).")
-                    logger.info(f"Пользователь {uid} вышел (удалил форму), форма удалена.")
-                    try:
-                        original_text = reply_msg.text
-                        if original_text:
-                            new_text = original_text + "\n\n✅ Пользователь вышел."
-                            await context.bot.edit_message_text(
-                                new_text,
-                                chat_id=reply_msg.chat_id,
-                                message_id=reply_msg.message_id,
-                                parse_mode=ParseMode.HTML
-                            )
-                    except Exception as e:
-                        logger.error(f"Ошибка при редактировании сообщения для пользователя {uid}: {e}")
-                else:
-                    await update.message.reply_text("❌ Форму может удалить только её автор или администратор.")
-                break
+        # Поиск формы по (чат, сообщение), чтобы совпадение id в разных чатах не закрыло чужую форму
+        form_id = report_index.get((reply_msg.chat_id, reply_msg.message_id))
+        if form_id is None and MULTI_INSTANCE:
+            # Форма другого экземпляра, ещё не попавшая в память этого
+            found = await run_db(db.find_active_by_report, reply_msg.chat_id, reply_msg.message_id)
+            if found is not None:
+                form = FormRecord.from_dict(found[1])
+                form_id = form.form_id
+                # За время запроса форму могло добавить перечитывание базы
+                if form_id not in active_forms:
+                    add_active_form(form)
+                    mark_active_forms_changed()
+        form = active_forms.get(form_id)
+        if form is None:
+            return
+
+        # Разрешаем удалять форму, если это автор формы ИЛИ пользователь в ADMIN_USERS
+        if (form.user_id == attempt_user_id) or (attempt_user_id in ADMIN_USERS):
+            remove_active_form(form_id)
+            mark_active_forms_changed()
+            schedule_status_board(context.job_queue)
+            exited_at = datetime.datetime.now(timezone.utc)
+            update_journal_entry(form, exited_at=exited_at)
+            log_change("exit", form_id=form_id, ts=exited_at.timestamp())
+            exit_delay = None
+            if form.exit_at is not None:
+                exit_delay = (exited_at - form.exit_at).total_seconds()
+            stats.remove_form(form.system, exit_delay)
+            mark_stats_dirty(context.job_queue)
+            logger.info("Пользователь %s вышел (закрыта форма %s), форма удалена.", form.user_id, form_id,
+                        extra={"form_id": form_id})
+            # Ответ и отметка во всех копиях отчёта и уведомлениях — одновременно
+            await asyncio.gather(
+                update.message.reply_text("👍 Форма удалена (статус: вышел)."),
+                propagate_exit(context, form, reply_msg)
+            )
+        else:
+            await update.message.reply_text("❌ Форму может удалить только её автор или администратор.")
+
+async def propagate_exit(context: ContextTypes.DEFAULT_TYPE, form: FormRecord, reply_msg=None):
+    """
+    Отметка о выходе во всех копиях отчёта формы (чат форм и чат алармов) и в её уведомлениях о сроках.
+    Сообщения правятся одновременно; ошибка одной правки не мешает остальным,
+    лимиты Telegram и повтор при RetryAfter — в sender.
+    """
+    edits = []
+    for chat_id, message_id in form.report_pairs():
+        if form.summary:
+            text = form.summary
+        elif reply_msg is not None and reply_msg.text and (chat_id, message_id) == (reply_msg.chat_id, reply_msg.message_id):
+            # Старая форма без сохранённого отчёта: правим только сообщение, на которое ответили
+            text = html.escape(reply_msg.text)
+        else:
+            continue
+        edits.append((chat_id, message_id, text))
+    edits.extend((chat_id, message_id, text) for chat_id, message_id, text in form.alert_msgs)
+
+    await asyncio.gather(*(mark_exit_in_message(context, form, *item) for item in edits))
+
+async def mark_exit_in_message(context: ContextTypes.DEFAULT_TYPE, form: FormRecord, chat_id, message_id, text: str):
+    """Отметка о выходе в одном сообщении формы; ошибка только записывается в журнал."""
+    try:
+        await sender.call(
+            chat_id,
+            context.bot.edit_message_text,
+            text + EXIT_MARK,
+            chat_id=chat_id,
+            message_id=message_id,
+            parse_mode=ParseMode.HTML
+        )
+    except BadRequest as e:
+        # Уже отмечено (повторный ответ) или сообщение удалено
+        if "not modified" not in str(e).lower():
+            logger.warning(f"Не удалось отметить выход в сообщении {message_id} чата {chat_id}: {e}")
+    except Exception as e:
+        logger.error(f"Ошибка при редактировании сообщения {message_id} чата {chat_id} формы {form.form_id}: {e}")
+
+def mark_active_forms_changed():
+    """Отметка об изменении набора активных форм: сброс готовых списков для /count, /status и сводки."""
+    global active_forms_version
+    active_forms_version += 1
 
+def format_active_line(form: FormRecord, style: str) -> str:
+    username = form.username or str(form.user_id)
+    if style == "status":
+        return f"• {username} (выход {form.date_up or '—'} {form.time_up or '—'}): {form.report_link()}"
+    return f"• {username}: {form.report_link()}"
+
+def render_active_lines(style: str) -> list:
+    """
+    Строки списка активных форм: style == "short" — имя и ссылки (/count, сводка),
+    "status" — ещё и время выхода (/status). Список строится заново только после
+    изменения набора активных форм, иначе возвращается готовый.
+    """
+    cached = rendered_active_lines.get(style)
+    if cached is not None and cached[0] == active_forms_version:
+        return cached[1]
+    lines = [format_active_line(form, style) for form in active_forms.values()]
+    rendered_active_lines[style] = (active_forms_version, lines)
+    return lines
+
+@timed("count")
 async def count_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    systems = {}
-    for form in active_forms.values():
-        sys_name = form.get("system")
-        if sys_name is not None:
-            systems.setdefault(sys_name, 0)
-            systems[sys_name] += 1
-    if not systems:
+    if not stats.active_by_system:
         await update.message.reply_text("Нет активных записей.")
         return
     lines = [f"Активные записи: {len(active_forms)}"]
-    for uid, form in active_forms.items():
-        username = form.get("username", str(uid))
-        chat_ids = form.get("chat_ids", [])
-        report_msg_ids = form.get("report_msg_ids", [])
-        if report_msg_ids and chat_ids:
-            links = []
-            for cid, mid in zip(chat_ids, report_msg_ids):
-                cid_str = str(cid)
-                if cid_str.startswith("-100"):
-                    links.append(f"https://t.me/c/{cid_str[4:]}/{mid}")
-                else:
-                    links.append("Нет ссылки")
-            link = " | ".join(links)
-        else:
-            link = "Нет ссылки"
-        lines.append(f"• {username}: {link}")
+    lines.extend(render_active_lines("short"))
     await update.message.reply_text("\n".join(lines))
 
+@timed("status")
 async def status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /status [система] — только формы этой системы (по индексу, без перебора всех форм)
+    system = " ".join(context.args) if context.args else None
+    if system:
+        forms = [active_forms[form_id] for form_id in forms_by_system.get(system_key(system), ())]
+        forms.sort(key=lambda form: form.filled_at or datetime.datetime.min.replace(tzinfo=timezone.utc))
+        if not forms:
+            await update.message.reply_text(f"Активных форм по системе {system} нет.")
+            return
+        lines = [f"Статус активных форм ({system}): {len(forms)}"]
+        lines.extend(format_active_line(form, "status") for form in forms)
+        await update.message.reply_text("\n".join(lines))
+        return
     if not active_forms:
         await update.message.reply_text("Активных форм нет.")
         return
     lines = [f"Статус активных форм: {len(active_forms)}"]
-    for uid, form in active_forms.items():
-        username = form.get("username", str(uid))
-        date_up = form.get("date_up", "—")
-        time_up = form.get("time_up", "—")
-        chat_ids = form.get("chat_ids", [])
-        report_msg_ids = form.get("report_msg_ids", [])
-        if report_msg_ids and chat_ids:
-            links = []
-            for cid, mid in zip(chat_ids, report_msg_ids):
-                cid_str = str(cid)
-                if cid_str.startswith("-100"):
-                    links.append(f"https://t.me/c/{cid_str[4:]}/{mid}")
-                else:
-                    links.append("Нет ссылки")
-            link = " | ".join(links)
-        else:
-            link = "Нет ссылки"
-        lines.append(f"• {username} (выход {date_up} {time_up}): {link}")
+    lines.extend(render_active_lines("status"))
+    await update.message.reply_text("\n".join(lines))
+
+@timed("stats")
+async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Статистика из накопленных счётчиков: активные формы, выходы по месяцам, опоздания, уведомления."""
+    lines = [f"📊 Активных форм: {sum(stats.active_by_system.values())}"]
+    for system, count in sorted(stats.active_by_system.items(), key=lambda item: -item[1]):
+        lines.append(f"• {system}: {count}")
+
+    months = sorted(stats.trips)[-STATS_MONTHS:]
+    if months:
+        lines.append("")
+        lines.append("Выходы по месяцам:")
+        for month in reversed(months):
+            by_system = sorted(stats.trips[month].items(), key=lambda item: -item[1])
+            # Только самые посещаемые системы, чтобы сообщение оставалось коротким
+            details = ", ".join(f"{system} — {count}" for system, count in by_system[:5])
+            if len(by_system) > 5:
+                details += f", ещё {len(by_system) - 5}"
+            lines.append(f"• {month}: {sum(count for _, count in by_system)} ({details})")
+
+    average_delay = stats.average_exit_delay()
+    if average_delay is not None:
+        lines.append("")
+        lines.append(f"Отмечено выходов: {stats.exit_count}, позже заявленного времени: {stats.late_exit_count}")
+        lines.append(f"Среднее отклонение от времени выхода: {average_delay / 60:+.0f} мин.")
+
+    lines.append("")
+    lines.append(f"Уведомлений «не вышел»: {stats.alerts.get('exit', 0)}, алармов: {stats.alerts.get('control', 0)}")
+    other_alerts = [f"{name} — {count}" for name, count in stats.alerts.items() if name not in ("exit", "control")]
+    if other_alerts:
+        lines.append(f"Других уведомлений: {', '.join(other_alerts)}")
     await update.message.reply_text("\n".join(lines))
 
 async def send_shraficheskie_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await send_to_reports(context, "Шрафичечски 😜", alarm_only=True)
     await update.message.reply_text("✅ Сообщение 'Шрафичечски' отправлено в чат для алармов.")
 
+def form_export_row(form: FormRecord) -> dict:
+    """Строка выгрузки /info и /journal для одной формы."""
+    return {
+        "User ID": form.user_id,
+        "Username": form.username,
+        "System": form.system,
+        "Дата выхода": form.date_up,
+        "Время выхода": form.time_up,
+        "Контроль": form.control,
+        "Заполнено (UTC)": form.filled_at.strftime("%Y-%m-%d %H:%M:%S") if form.filled_at else None,
+        "Не вышел уведомлено": form.not_exited_notified,
+        "Аларм уведомлено": form.alarm_notified,
+        "Вышел (UTC)": form.exited_at.strftime("%Y-%m-%d %H:%M:%S") if form.exited_at else None,
+        "Отчёт": form.report_link()
+    }
+
+# Колонки выгрузки в порядке следования
+EXPORT_COLUMNS = [
+    "User ID", "Username", "System", "Дата выхода", "Время выхода", "Контроль",
+    "Заполнено (UTC)", "Не вышел уведомлено", "Аларм уведомлено", "Вышел (UTC)", "Отчёт"
+]
+
+async def reply_with_table(update: Update, name: str, sheet_name: str, rows, caption) -> int:
+    """
+    Запись строк выгрузки во временный файл в пуле потоков и отправка его документом.
+    caption — функция от количества строк. Возвращает количество строк; пустая таблица не отправляется.
+    """
+    fd, path = tempfile.mkstemp(prefix=f"{name}_")
+    os.close(fd)
+    try:
+        loop = asyncio.get_running_loop()
+        count = await loop.run_in_executor(None, write_table, path, sheet_name, EXPORT_COLUMNS, rows)
+        if count:
+            with open(path, "rb") as f:
+                await update.message.reply_document(
+                    document=f,
+                    filename=f"{name}.{table_extension()}",
+                    caption=caption(count)
+                )
+    finally:
+        os.remove(path)
+    return count
+
+@timed("info")
 async def info_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Команда /info работает только в личном чате и выдаёт Excel с активными формами
     if update.effective_chat.type != ChatType.PRIVATE:
@@ -414,190 +1488,303 @@ async def info_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Нет активных форм для формирования отчёта.")
         return
 
-    data = []
-    for uid, form in active_forms.items():
-        chat_ids = form.get("chat_ids", [])
-        report_msg_ids = form.get("report_msg_ids", [])
-        if report_msg_ids and chat_ids:
-            links = []
-            for cid, mid in zip(chat_ids, report_msg_ids):
-                cid_str = str(cid)
-                if cid_str.startswith("-100"):
-                    links.append(f"https://t.me/c/{cid_str[4:]}/{mid}")
-                else:
-                    links.append("Нет ссылки")
-            link = " | ".join(links)
-        else:
-            link = "Нет ссылки"
-        data.append({
-            "User ID": form.get("user_id"),
-            "Username": form.get("username"),
-            "System": form.get("system"),
-            "Дата выхода": form.get("date_up"),
-            "Время выхода": form.get("time_up"),
-            "Контроль": form.get("control"),
-            "Заполнено (UTC)": form.get("filled_at"),
-            "Не вышел уведомлено": form.get("not_exited_notified"),
-            "Аларм уведомлено": form.get("alarm_notified"),
-            "Отчёт": link
-        })
-    df = pd.DataFrame(data)
-    
-    excel_buffer = io.BytesIO()
-    with pd.ExcelWriter(excel_buffer, engine="xlsxwriter") as writer:
-        df.to_excel(writer, index=False, sheet_name="Статистика (Активные)")
-    excel_buffer.seek(0)
-    
-    await update.message.reply_document(document=excel_buffer, filename="active_forms.xlsx", caption="Статистика активных форм.")
+    rows = [form_export_row(form) for form in active_forms.values()]
+    await reply_with_table(update, "active_forms", "Статистика (Активные)", rows, lambda count: "Статистика активных форм.")
 
+def parse_journal_filter(args: list):
+    """
+    Разбор аргументов /journal: [дата с] [дата по] [система].
+    Даты в формате YYYY-MM-DD (по дате выхода), всё остальное — название системы.
+    """
+    dates = []
+    words = []
+    for arg in args:
+        try:
+            dates.append(datetime.date.fromisoformat(arg).isoformat())
+        except ValueError:
+            words.append(arg)
+    if len(dates) > 2:
+        raise ValueError("слишком много дат")
+    date_from = dates[0] if dates else None
+    date_to = dates[1] if len(dates) > 1 else None
+    system = " ".join(words) if words else None
+    return date_from, date_to, system
+
+def journal_record_matches(record: FormRecord, date_from, date_to, system_key) -> bool:
+    # Даты YYYY-MM-DD сравниваются как строки, без разбора
+    if date_from or date_to:
+        if not record.date_up:
+            return False
+        day = record.date_up[:10]
+        if date_from and day < date_from:
+            return False
+        if date_to and day > date_to:
+            return False
+    if system_key and (record.system or "").casefold() != system_key:
+        return False
+    return True
+
+@timed("journal")
 async def journal_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Команда /journal работает только в личном чате и выдаёт Excel с журналом всех форм
+    # Команда /journal работает только в личном чате и выдаёт Excel с журналом всех форм.
+    # Необязательные аргументы: /journal [YYYY-MM-DD] [YYYY-MM-DD] [система]
     if update.effective_chat.type != ChatType.PRIVATE:
         return
-    if not journal_forms:
+    await ensure_journal()
+    if db is None and not journal_forms and not pending_archive and not journal_archive.months():
         await update.message.reply_text("Журнал форм пуст.")
         return
 
-    data = []
-    for record in journal_forms:
-        chat_ids = record.get("chat_ids", [])
-        report_msg_ids = record.get("report_msg_ids", [])
-        if report_msg_ids and chat_ids:
-            links = []
-            for cid, mid in zip(chat_ids, report_msg_ids):
-                cid_str = str(cid)
-                if cid_str.startswith("-100"):
-                    links.append(f"https://t.me/c/{cid_str[4:]}/{mid}")
-                else:
-                    links.append("Нет ссылки")
-            link = " | ".join(links)
-        else:
-            link = "Нет ссылки"
-        data.append({
-            "User ID": record.get("user_id"),
-            "Username": record.get("username"),
-            "System": record.get("system"),
-            "Дата выхода": record.get("date_up"),
-            "Время выхода": record.get("time_up"),
-            "Контроль": record.get("control"),
-            "Заполнено (UTC)": record.get("filled_at"),
-            "Не вышел уведомлено": record.get("not_exited_notified"),
-            "Аларм уведомлено": record.get("alarm_notified"),
-            "Отчёт": link
-        })
-    df = pd.DataFrame(data)
-    
-    excel_buffer = io.BytesIO()
-    with pd.ExcelWriter(excel_buffer, engine="xlsxwriter") as writer:
-        df.to_excel(writer, index=False, sheet_name="Журнал")
-    excel_buffer.seek(0)
-    
-    await update.message.reply_document(document=excel_buffer, filename="journal.xlsx", caption="Журнал всех форм.")
+    try:
+        date_from, date_to, system = parse_journal_filter(context.args or [])
+    except ValueError:
+        await update.message.reply_text("Использование: /journal [YYYY-MM-DD] [YYYY-MM-DD] [система]")
+        return
 
+    system_key = system.casefold() if system else None
+    # Строки формируются по мере записи в файл; новые формы, добавленные во время выгрузки, не попадают в неё
+    if db is not None:
+        rows = (
+            form_export_row(FormRecord.from_dict(data))
+            for data in db.iter_journal(date_from, date_to, system_key)
+        )
+    else:
+        # Из архива читаются только сегменты месяцев, попадающих в период
+        # Записи, убранные из журнала, но ещё не дописанные в архив, берутся из очереди архива;
+        # если сегмент допишется во время выгрузки, их копии из сегмента пропускаются
+        pending = pending_archive_records(date_from and date_from[:7], date_to and date_to[:7])
+        pending_ids = {record.form_id for record in pending}
+        archived = itertools.chain(
+            (
+                record
+                for record in (
+                    FormRecord.from_dict(data)
+                    for data in journal_archive.iter_records(date_from and date_from[:7], date_to and date_to[:7])
+                )
+                if record.form_id not in pending_ids
+            ),
+            pending
+        )
+        journal = journal_forms
+        end = len(journal)
+        current = (journal[i] for i in range(end))
+        rows = (
+            form_export_row(record)
+            for record in itertools.chain(archived, current)
+            if journal_record_matches(record, date_from, date_to, system_key)
+        )
+
+    details = ""
+    if date_from or date_to:
+        details += f" Период: {date_from or '…'} — {date_to or '…'}."
+    if system:
+        details += f" Система: {system}."
+    count = await reply_with_table(update, "journal", "Журнал", rows, lambda count: f"Журнал форм: {count} записей.{details}")
+    if count == 0:
+        await update.message.reply_text("Нет записей по заданному фильтру.")
+
+@timed("monitor_underground_count")
 async def monitor_underground_count(context: ContextTypes.DEFAULT_TYPE):
     """
     Периодическая отправка статистики по количеству активных форм.
     Если активных форм нет — не отправляем сообщение.
     """
+    if not is_leader:
+        return
     count = len(active_forms)
     if count == 0:
         # Если активных форм нет, ничего не отправляем
         return
 
     lines = [f"📊 Активных записей: {count}"]
-    for uid, form in active_forms.items():
-        username = form.get("username", str(uid))
-        chat_ids = form.get("chat_ids", [])
-        report_msg_ids = form.get("report_msg_ids", [])
-        if report_msg_ids and chat_ids:
-            links = []
-            for cid, mid in zip(chat_ids, report_msg_ids):
-                cid_str = str(cid)
-                if cid_str.startswith("-100"):
-                    links.append(f"https://t.me/c/{cid_str[4:]}/{mid}")
-                else:
-                    links.append("Нет ссылки")
-            link = " | ".join(links)
-        else:
-            link = "Нет ссылки"
-        lines.append(f"• {username}: {link}")
+    lines.extend(render_active_lines("short"))
     summary_text = "\n".join(lines)
     await send_to_reports(context, summary_text, alarm_only=True)
 
-async def monitor_exit_deadlines(context: ContextTypes.DEFAULT_TYPE):
+def render_status_board() -> list:
+    """Тексты сообщений табло: заголовок и список активных форм, поделённый по STATUS_BOARD_PAGE_SIZE."""
+    lines = render_active_lines("status")
+    if not lines:
+        return ["📊 Под землёй никого нет."]
+    pages = []
+    page = [f"📊 Под землёй: {len(active_forms)}"]
+    size = len(page[0])
+    for line in lines:
+        # Одна строка не длиннее четверти сообщения (много ссылок на отчёты)
+        line = line[:STATUS_BOARD_PAGE_SIZE // 4]
+        if size + 1 + len(line) > STATUS_BOARD_PAGE_SIZE:
+            pages.append("\n".join(page))
+            page = ["📊 Продолжение:"]
+            size = len(page[0])
+        page.append(line)
+        size += 1 + len(line)
+    pages.append("\n".join(page))
+    return pages
+
+def schedule_status_board(job_queue):
+    """Обновление табло через STATUS_BOARD_DEBOUNCE секунд: все изменения за это время — одной правкой."""
+    global status_board_job
+    if STATUS_BOARD_CHATS and status_board_job is None:
+        status_board_job = job_queue.run_once(update_status_board, when=STATUS_BOARD_DEBOUNCE)
+
+async def update_status_board(context: ContextTypes.DEFAULT_TYPE):
+    """Приведение табло во всех чатах к текущему набору активных форм (чаты — одновременно)."""
+    global status_board_job
+    status_board_job = None
+    if not is_leader:
+        return
+    pages = render_status_board()
+    changed = await asyncio.gather(*(sync_status_board(context, chat_id, pages) for chat_id in STATUS_BOARD_CHATS))
+    if any(changed):
+        save_status_board()
+
+async def sync_status_board(context: ContextTypes.DEFAULT_TYPE, chat_id: int, pages: list) -> bool:
     """
-    Периодическая проверка: если время выхода прошло, а форма не закрыта — уведомляем.
-    Если время контрольное (с датой!) прошло, уведомляем об аларме.
-    Если в форме не передана дата для контроля, используем дату выхода.
-    Если контрольное время (HH:MM) <= времени выхода, считаем, что контроль — это следующий день.
+    Правка сообщений табло в чате: меняются только страницы с изменившимся текстом,
+    недостающие отправляются (первая закрепляется), лишние удаляются.
+    Возвращает True, если сообщения табло изменились.
     """
-    now = datetime.datetime.now(timezone.utc)
-    logger.info(f"⏰ Мониторинг сроков: сейчас {now}")
-    for uid, form in list(active_forms.items()):
+    state = status_board.setdefault(str(chat_id), {"message_ids": [], "texts": []})
+    message_ids, texts = state["message_ids"], state["texts"]
+    no_preview = LinkPreviewOptions(is_disabled=True)
+    changed = False
+    for i, text in enumerate(pages):
+        if i < len(message_ids):
+            if texts[i] == text:
+                continue
+            try:
+                await sender.call(chat_id, context.bot.edit_message_text, text=text, chat_id=chat_id,
+                                  message_id=message_ids[i], link_preview_options=no_preview)
+                texts[i] = text
+                changed = True
+                continue
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    texts[i] = text
+                    changed = True
+                    continue
+                # Сообщение табло удалили из чата — отправляем новое вместо него
+                logger.warning(f"Не удалось изменить табло в чате {chat_id}: {e}")
+            except Exception as e:
+                logger.error(f"Ошибка обновления табло в чате {chat_id}: {e}")
+                continue
         try:
-            date_up_str = form.get("date_up")
-            time_up_str = form.get("time_up")
-            control_str = form.get("control")
-
-            logger.info(f"Проверка для пользователя {uid}: date_up={date_up_str}, time_up={time_up_str}, control={control_str}")
+            msg = await sender.send_message(context.bot, chat_id, text, link_preview_options=no_preview)
+        except Exception as e:
+            logger.error(f"Ошибка отправки табло в чат {chat_id}: {e}")
+            return changed
+        changed = True
+        if i < len(message_ids):
+            message_ids[i] = msg.message_id
+            texts[i] = text
+        else:
+            message_ids.append(msg.message_id)
+            texts.append(text)
+        if i == 0:
+            try:
+                await sender.call(chat_id, context.bot.pin_chat_message, chat_id=chat_id,
+                                  message_id=msg.message_id, disable_notification=True)
+            except Exception as e:
+                logger.warning(f"Не удалось закрепить табло в чате {chat_id}: {e}")
+    # Список стал короче — лишние страницы удаляются
+    while len(message_ids) > len(pages):
+        message_id = message_ids.pop()
+        texts.pop()
+        changed = True
+        try:
+            await sender.call(chat_id, context.bot.delete_message, chat_id=chat_id, message_id=message_id)
+        except Exception as e:
+            logger.warning(f"Не удалось удалить страницу табло в чате {chat_id}: {e}")
+    return changed
 
-            # Дата и время выхода
-            local_exit_dt_local = datetime.datetime.strptime(
-                f"{date_up_str} {time_up_str}",
-                "%Y-%m-%d %H:%M"
-            ).replace(tzinfo=TZ_LOCAL)
-            local_exit_dt = local_exit_dt_local.astimezone(timezone.utc)
+async def send_stage_alert(context: ContextTypes.DEFAULT_TYPE, form: FormRecord, stage: dict, due_at,
+                           delayed: bool = False):
+    """
+    Уведомление стадии stage по форме, срок которой due_at наступил, и переход к следующему сроку стадии.
+    delayed — срок пропущен, к тексту добавляется, на сколько уведомление опоздало.
+    """
+    # Уведомление могло ждать своей очереди (пропущенные идут по одному и упираются в лимит чата):
+    # форму за это время могли закрыть, а срок стадии — обработать
+    if form.form_id not in active_forms or stage_due(form, stage) != due_at:
+        return
+    try:
+        msg = stage["text"].format(
+            user=f'<a href="tg://user?id={form.user_id}">{html.escape(form.username or "—")}</a>',
+            system=html.escape(form.system or "—"),
+            date_up=html.escape(form.date_up or ""),
+            time_up=html.escape(form.time_up or ""),
+            control=html.escape(form.control or ""),
+            overdue=format_overdue((datetime.datetime.now(timezone.utc) - stage_base(form, stage)).total_seconds()),
+        )
+        if delayed:
+            delay = format_overdue((datetime.datetime.now(timezone.utc) - due_at).total_seconds())
+            msg += f"\n⏱ Уведомление задержано на {delay}: бот был недоступен."
+        # В чатах с отчётом формы — ответом на отчёт
+        sent = await send_to_chats(context, stage_chats(stage), msg, reply_to_map=dict(form.report_pairs()))
+        if form.form_id not in active_forms:
+            # Форму закрыли во время отправки: propagate_exit этих сообщений уже не видел — отмечаем выход в них
+            await asyncio.gather(*(mark_exit_in_message(context, form, chat_id, msg_id, msg) for chat_id, msg_id in sent))
+            return
+        if sent:
+            # Чтобы при выходе отметить его и в уведомлениях
+            mark_flag(form, "alert_msgs", form.alert_msgs + [[chat_id, msg_id, msg] for chat_id, msg_id in sent])
+        now = datetime.datetime.now(timezone.utc)
+        ALERT_LATENESS.observe((now - due_at).total_seconds(), kind=stage["name"])
+        monitor_logger.info("Уведомление «%s» по форме %s: %s", stage["name"], form.form_id, msg,
+                            extra={"form_id": form.form_id, "stage": stage["name"]})
+        advance_stage(form, stage, now)
+        stats.add_alert(stage["name"])
+        mark_stats_dirty()
+    except Exception as e:
+        logger.error(f"Ошибка уведомления «{stage['name']}» по форме {form.form_id}: {e}")
 
-            # Проверяем контрольное время
-            try:
-                # Предполагаем, что control_str может быть "YYYY-MM-DD HH:MM"
-                local_control_dt = datetime.datetime.strptime(control_str, "%Y-%m-%d %H:%M") \
-                    .replace(tzinfo=TZ_LOCAL).astimezone(timezone.utc)
-            except:
-                # Значит, control_str — только "HH:MM", добавим дату выхода
-                temp_local_control = datetime.datetime.strptime(
-                    f"{date_up_str} {control_str}",
-                    "%Y-%m-%d %H:%M"
-                ).replace(tzinfo=TZ_LOCAL)
-
-                # Если контрольный временной момент <= времени выхода — считаем, что контроль на следующий день
-                if temp_local_control <= local_exit_dt_local:
-                    temp_local_control += datetime.timedelta(days=1)
-
-                local_control_dt = temp_local_control.astimezone(timezone.utc)
-
-            reply_map = {}
-            chat_ids = form.get("chat_ids", [])
-            report_msg_ids = form.get("report_msg_ids", [])
-            for cid, mid in zip(chat_ids, report_msg_ids):
-                reply_map[cid] = mid
-
-            # 1) Предупреждение: время выхода прошло, а not_exited_notified ещё нет
-            if now > local_exit_dt and not form.get("not_exited_notified"):
-                user_mention = f'<a href="tg://user?id={form.get("user_id")}">' \
-                               f'{html.escape(form.get("username"))}</a>'
-                msg = (f"🚨 {user_mention} не вышел к назначенному времени "
-                       f"(было: {html.escape(date_up_str)} {html.escape(time_up_str)}).")
-                # Отправляем предупреждение в чат для алармов
-                await send_to_reports(context, msg, parse_mode=ParseMode.HTML, reply_to_map=reply_map, alarm_only=True)
-                logger.info(msg)
-                form["not_exited_notified"] = True
-                save_forms()
-
-            # 2) Аларм: время контрольное прошло, а alarm_notified ещё нет
-            if now > local_control_dt and not form.get("alarm_notified"):
-                user_mention = f'<a href="tg://user?id={form.get("user_id")}">' \
-                               f'{html.escape(form.get("username"))}</a>'
-                msg = (f"🔥 Аларм! {user_mention} задержался сверх контрольного времени "
-                       f"(было: {html.escape(date_up_str)} {html.escape(control_str)}).")
-                # Отправляем аларм в чат для алармов
-                await send_to_reports(context, msg, parse_mode=ParseMode.HTML, reply_to_map=reply_map, alarm_only=True)
-                logger.info(msg)
-                form["alarm_notified"] = True
-                save_forms()
+async def send_missed_alerts(context: ContextTypes.DEFAULT_TYPE, missed: list):
+    """Пропущенные уведомления — по одному, чтобы в чате они шли в порядке сроков."""
+    for form, stage, deadline_at in missed:
+        await send_stage_alert(context, form, stage, deadline_at, delayed=True)
 
-        except Exception as e:
-            logger.error(f"Ошибка при проверке формы пользователя {uid}: {e}")
+@timed("monitor_exit_deadlines")
+async def monitor_exit_deadlines(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Обработка наступивших сроков стадий уведомлений из очереди deadline_queue
+    (не вышел, аларм, повторные напоминания, эскалация — см. ESCALATION_STAGES).
+    Уведомления по наступившим срокам отправляются одновременно, а сроки, пропущенные
+    за время остановки бота, — по одному в порядке сроков;
+    следующий срок стадии ставится в очередь после отправки.
+    После обработки планируем следующий запуск к ближайшему оставшемуся сроку.
+    """
+    global deadline_job
+    deadline_job = None
+    async with monitor_lock:
+        if MULTI_INSTANCE:
+            # Уведомления отправляет только ведущий, и только по актуальному состоянию базы
+            if not await hold_monitor_lease():
+                return
+            await reload_shared_state()
+        now = datetime.datetime.now(timezone.utc)
+        alerts = []
+        missed = []
+        while deadline_queue and deadline_queue[0][0] <= now:
+            deadline_at, form_id, name = heapq.heappop(deadline_queue)
+            form = active_forms.get(form_id)
+            stage = STAGES_BY_NAME.get(name)
+            # Форма уже закрыта, стадия убрана из настроек или срок уже обработан — пропускаем
+            if form is None or stage is None or stage_due(form, stage) != deadline_at:
+                continue
+            # Пропущен ботом только срок, наступивший до начала мониторинга, у формы, отправленной тоже до него;
+            # срок, прошедший ещё до отправки формы при работающем боте, — обычное уведомление
+            if deadline_at < monitor_started_at and (form.filled_at or deadline_at) < monitor_started_at:
+                # Очередь отдаёт сроки по возрастанию — missed уже в порядке сроков
+                missed.append((form, stage, deadline_at))
+            else:
+                alerts.append(send_stage_alert(context, form, stage, deadline_at))
+        if missed:
+            logger.info(f"Пропущенных сроков: {len(missed)}, самый ранний — {missed[0][2].isoformat()}; "
+                        f"уведомления отправляются по порядку.")
+        await asyncio.gather(send_missed_alerts(context, missed), *alerts)
+        # Все отметки прохода — одной пачкой
+        flush_pending_changes()
+        schedule_deadline_check(context.job_queue)
 
 async def my_chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -612,12 +1799,41 @@ async def my_chat_member_handler(update: Update, context: ContextTypes.DEFAULT_T
         logger.info(f"Обновление членства в чате: {chat.id} - {known_chats[str(chat.id)]}")
 
 def main():
-    # Загружаем сохранённые формы, журнал и известные чаты при запуске
+    setup_logging(LOG_LEVELS, LOG_FORMAT, LOG_FILE)
+    if LOG_MONITOR_SAMPLE:
+        monitor_logger.addFilter(SampleFilter(LOG_MONITOR_SAMPLE))
+    # При запуске читаем только активные формы, известные чаты и статистику: пропущенные
+    # за время остановки сроки проверяются сразу, а журнал читается следом (warm_up_journal)
+    started = time.perf_counter()
+    open_storage()
+    if MULTI_INSTANCE and db is None:
+        logger.error('MULTI_INSTANCE требует STORAGE_BACKEND = "sqlite".')
+        return
     load_forms()
     load_known_chats()
-    load_journal()
+    load_stats()
+    load_status_board()
+    persistence.start()
+    build_deadline_queue()
+    now = datetime.datetime.now(timezone.utc)
+    missed = sum(1 for deadline_at, _, _ in deadline_queue if deadline_at <= now)
+    logger.info(f"Состояние загружено за {time.perf_counter() - started:.3f} с: активных форм {len(active_forms)}, "
+                f"наступивших сроков {missed}.")
+    ACTIVE_FORMS.set_function(lambda: len(active_forms))
+    if METRICS_PORT:
+        try:
+            start_http_server(METRICS_LISTEN, METRICS_PORT)
+        except OSError as e:
+            # Например, порт занят: бот работает и без метрик
+            logger.error(f"Не удалось запустить сервер метрик на {METRICS_LISTEN}:{METRICS_PORT}: {e}")
     
-    application = ApplicationBuilder().token(TOKEN).build()
+    application = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, web_app_data_handler))
@@ -625,6 +1841,7 @@ def main():
     application.add_handler(CommandHandler("sendshraficheskie", send_shraficheskie_handler))
     application.add_handler(CommandHandler("count", count_handler))
     application.add_handler(CommandHandler("status", status_handler))
+    application.add_handler(CommandHandler("stats", stats_handler))
     application.add_handler(CommandHandler("info", info_handler))
     application.add_handler(CommandHandler("journal", journal_handler))
     application.add_handler(MessageHandler(filters.REPLY & filters.TEXT, group_reply_handler))
@@ -634,13 +1851,41 @@ def main():
     application.add_error_handler(lambda update, context: logger.error("Exception while handling an update:", exc_info=context.error))
 
     job_queue = application.job_queue
-    # Каждые 4 часа отправляем статистику (но только если есть активные формы)
-    job_queue.run_repeating(monitor_underground_count, interval=14400, first=10)
-    # Каждые 5 минут проверяем сроки выхода и контрольное время
-    job_queue.run_repeating(monitor_exit_deadlines, interval=300, first=20)
+    if STATUS_BOARD_CHATS:
+        # Табло сверяется с активными формами после запуска, дальше — при их изменении
+        schedule_status_board(job_queue)
+    else:
+        # Каждые 4 часа отправляем статистику (но только если есть активные формы)
+        job_queue.run_repeating(monitor_underground_count, interval=14400, first=10)
+    # Сроки выхода и контрольное время проверяются точно в момент ближайшего срока
+    # (пропущенные за время остановки — сразу после старта)
+    if MULTI_INSTANCE:
+        # Проверку сроков запланирует тот экземпляр, который получит аренду
+        job_queue.run_repeating(maintain_monitor_lease, interval=LEASE_RENEW_INTERVAL, first=0)
+    else:
+        schedule_deadline_check(job_queue)
+    if db is None:
+        # Всё, что накопилось в журнале изменений, переносим в снимки, а прошлые месяцы журнала — в архив
+        job_queue.run_once(warm_up_journal, when=1)
 
     logger.info("Бот запущен. Ожидание обновлений... 🚀")
-    application.run_polling()
+    if UPDATE_MODE == "webhook":
+        asyncio.run(run_webhook_server(
+            application,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            webhook_url=WEBHOOK_URL,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        ))
+    else:
+        application.run_polling()
+    # Дописываем на диск всё, что осталось в очереди записи
+    persistence.stop()
+    if MULTI_INSTANCE and is_leader:
+        # Отметки об уведомлениях уже в базе — следующий ведущий может забрать аренду сразу
+        db.release_lease(MONITOR_LEASE, instance_id)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,64 @@
+"""
+Выгрузка таблиц в Excel.
+
+Функции синхронные и предназначены для запуска в пуле потоков (run_in_executor).
+xlsxwriter загружается при первой выгрузке; если он не установлен,
+таблица пишется в CSV средствами стандартной библиотеки.
+"""
+import csv
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Модуль xlsxwriter после первой загрузки; False — библиотека не установлена
+_xlsxwriter = None
+
+
+def _load_xlsxwriter():
+    global _xlsxwriter
+    if _xlsxwriter is None:
+        try:
+            import xlsxwriter
+            _xlsxwriter = xlsxwriter
+        except ImportError:
+            logger.warning("xlsxwriter не установлен, выгрузки будут в формате CSV.")
+            _xlsxwriter = False
+    return _xlsxwriter or None
+
+
+def table_extension() -> str:
+    """Расширение файла, в который пишет write_table."""
+    return "xlsx" if _load_xlsxwriter() else "csv"
+
+
+def write_table(path: str, sheet_name: str, columns: list, rows) -> int:
+    """
+    Запись строк (словарей с ключами из columns) в файл. Возвращает количество строк.
+    Строки пишутся по одной, поэтому объём памяти не зависит от размера выгрузки.
+    """
+    xlsxwriter = _load_xlsxwriter()
+    if xlsxwriter is None:
+        return _write_csv(path, columns, rows)
+
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    try:
+        worksheet = workbook.add_worksheet(sheet_name)
+        header_format = workbook.add_format({"bold": True})
+        worksheet.write_row(0, 0, columns, header_format)
+        count = 0
+        for count, row in enumerate(rows, start=1):
+            worksheet.write_row(count, 0, [row.get(column) for column in columns])
+    finally:
+        workbook.close()
+    return count
+
+
+def _write_csv(path: str, columns: list, rows) -> int:
+    # utf-8-sig, чтобы Excel правильно определил кодировку кириллицы
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        count = 0
+        for count, row in enumerate(rows, start=1):
+            writer.writerow([row.get(column) for column in columns])
+    return count
@@ -0,0 +1,110 @@
+"""
+Журнал работы бота без блокировки цикла событий.
+
+Записи из всех потоков попадают в очередь (QueueHandler), а форматирование
+и вывод в stderr или файл выполняет отдельный поток QueueListener: медленный
+диск или терминал не задерживает обработку обновлений. Сообщения с аргументами
+в стиле logger.info("... %s", value) форматируются тоже в этом потоке.
+"""
+import atexit
+import datetime
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+import serializer
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Стандартные атрибуты LogRecord; остальные (из extra=...) попадают в JSON как поля записи
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, логгер, сообщение и поля из extra."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRS:
+                data[name] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        return serializer.dumps_line(data)
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не форматирует сообщение в потоке вызова."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info and not record.exc_text:
+            # Трассировку сохраняем сразу: кадры стека к моменту вывода уже изменятся
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SampleFilter(logging.Filter):
+    """
+    Не больше limit записей за period секунд; о пропущенных сообщает
+    следующая прошедшая запись.
+    """
+
+    def __init__(self, limit: int, period: float = 60):
+        super().__init__()
+        self.limit = limit
+        self.period = period
+        self._window_start = 0.0
+        self._count = 0
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._window_start >= self.period:
+                self._window_start = now
+                self._count = 0
+            if self._count >= self.limit:
+                self._dropped += 1
+                return False
+            self._count += 1
+            if self._dropped:
+                # Дописываем к шаблону, а не к готовому тексту: аргументы форматируются позже
+                record.msg = f"{record.msg} (пропущено похожих записей: {self._dropped})"
+                self._dropped = 0
+        return True
+
+
+def setup_logging(levels: dict, log_format: str = "text", path: str = "") -> logging.handlers.QueueListener:
+    """
+    Настройка журнала: levels — {имя логгера: уровень}, "" — корневой логгер.
+    Поток вывода останавливается (с записью оставшихся сообщений) при выходе из процесса.
+    """
+    if path:
+        output = logging.FileHandler(path, encoding="utf-8")
+    else:
+        output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_LazyQueueHandler(log_queue))
+    for name, level in levels.items():
+        logging.getLogger(name or None).setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,226 @@
+"""
+Метрики бота в текстовом формате Prometheus.
+
+Счётчики, показатели и гистограммы хранятся в памяти процесса; их обновляют
+цикл событий и поток записи, поэтому каждое значение меняется под своим lock.
+HTTP-сервер /metrics работает в отдельном потоке и не зависит от режима получения обновлений.
+"""
+import functools
+import logging
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм по умолчанию (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Опоздание уведомлений: от долей секунды до часа
+LATENESS_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 300, 900, 3600)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self) -> list:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(self._values.items())]
+
+
+class Counter(_Metric):
+    """Монотонно растущий счётчик."""
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Текущее значение; может вычисляться функцией в момент чтения метрик."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function) -> None:
+        self._function = function
+
+    def _render_samples(self) -> list:
+        if self._function is not None:
+            return [f"{self.name} {_format_value(self._function())}"]
+        return super()._render_samples()
+
+
+class Histogram(_Metric):
+    """Гистограмма с накопительными корзинами, суммой и количеством наблюдений."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        """Контекстный менеджер: наблюдение длительности блока."""
+        return _Timer(self, labels)
+
+    def _render_samples(self) -> list:
+        lines = []
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.register(Histogram(
+    "cavesmonitor_handler_seconds", "Время обработки обновления или задачи", ["handler"]))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    "cavesmonitor_handler_errors_total", "Исключения в обработчиках", ["handler"]))
+PERSISTENCE_SECONDS = REGISTRY.register(Histogram(
+    "cavesmonitor_persistence_write_seconds", "Время записи данных на диск", ["kind"]))
+PERSISTENCE_BYTES = REGISTRY.register(Counter(
+    "cavesmonitor_persistence_written_bytes_total", "Записано байт в файлы данных", ["kind"]))
+TELEGRAM_SECONDS = REGISTRY.register(Histogram(
+    "cavesmonitor_telegram_request_seconds", "Время запроса к Telegram Bot API", ["method"]))
+TELEGRAM_ERRORS = REGISTRY.register(Counter(
+    "cavesmonitor_telegram_errors_total", "Ошибки запросов к Telegram Bot API", ["method", "error"]))
+ACTIVE_FORMS = REGISTRY.register(Gauge(
+    "cavesmonitor_active_forms", "Количество активных форм"))
+ALERT_LATENESS = REGISTRY.register(Histogram(
+    "cavesmonitor_alert_lateness_seconds", "Опоздание уведомления относительно срока", ["kind"],
+    buckets=LATENESS_BUCKETS))
+
+
+def timed(handler: str):
+    """Декоратор корутины-обработчика: время выполнения и исключения с меткой handler."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=handler)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - start, handler=handler)
+        return wrapper
+    return decorator
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Запросы сборщика метрик не пишем в лог бота
+        pass
+
+
+def start_http_server(listen: str, port: int) -> ThreadingHTTPServer:
+    """Запуск сервера /metrics в фоновом потоке."""
+    server = ThreadingHTTPServer((listen, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Метрики доступны на http://{listen}:{port}/metrics")
+    return server
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Локальная проверка webhook-режима: отправка Update в JSON боту, запущенному
+с UPDATE_MODE = "webhook", так же, как это делает Telegram.
+
+    python post_update.py update.json
+    python post_update.py update.json --url http://127.0.0.1:8443/telegram
+"""
+import argparse
+import json
+import urllib.request
+
+from bot import WEBHOOK_LISTEN, WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET_TOKEN
+from webhook import SECRET_HEADER
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Отправка Update в локальный webhook бота")
+    parser.add_argument("update_file", help="JSON-файл с объектом Update")
+    parser.add_argument("--url", default=f"http://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+    parser.add_argument("--secret", default=WEBHOOK_SECRET_TOKEN)
+    args = parser.parse_args()
+
+    with open(args.update_file, "r", encoding="utf-8") as f:
+        body = json.dumps(json.load(f)).encode("utf-8")
+    request = urllib.request.Request(args.url, data=body, method="POST")
+    request.add_header("Content-Type", "application/json")
+    if args.secret:
+        request.add_header(SECRET_HEADER, args.secret)
+    with urllib.request.urlopen(request) as response:
+        print(response.status)
+
+
+if __name__ == "__main__":
+    main()
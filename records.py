@@ -0,0 +1,159 @@
+"""
+Модель записи формы.
+
+FormRecord хранит только данные, нужные для мониторинга и отчётов, с уже
+разобранными датами. В файлах записи хранятся в виде словаря прежнего формата
+(to_dict/from_dict), поэтому старые active_forms.json и journal_forms.json читаются как есть.
+"""
+import datetime
+
+from datetime import timezone
+
+
+def _parse_utc(value):
+    """Разбор ISO-строки; время без часового пояса считается UTC."""
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    dt = datetime.datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def _from_ts(value):
+    if value is None:
+        return None
+    return datetime.datetime.fromtimestamp(value, timezone.utc)
+
+
+def make_form_id(user_id, filled_at) -> str:
+    """
+    Идентификатор формы: пользователь и время заполнения в миллисекундах.
+    Для старых записей без form_id вычисляется так же, поэтому активная форма
+    и её запись журнала получают одинаковый идентификатор.
+    """
+    ms = int(filled_at.timestamp() * 1000) if filled_at is not None else 0
+    return f"{user_id}-{ms}"
+
+
+class FormRecord:
+    """Запись активной формы или журнала."""
+
+    __slots__ = (
+        "form_id",
+        "user_id",
+        "username",
+        "system",
+        "date_up",
+        "time_up",
+        "control",
+        "filled_at",
+        "exit_at",
+        "control_at",
+        "exited_at",
+        "report_msg_ids",
+        "chat_ids",
+        "alert_msgs",
+        "not_exited_notified",
+        "alarm_notified",
+        "escalation",
+        "summary",
+        "_report_link",
+    )
+
+    def __init__(self, user_id: int, username: str, system=None, date_up=None, time_up=None,
+                 control=None, filled_at=None, exit_at=None, control_at=None,
+                 report_msg_ids=None, chat_ids=None,
+                 not_exited_notified: bool = False, alarm_notified: bool = False, summary: str = None,
+                 form_id: str = None, exited_at=None, escalation: dict = None, alert_msgs: list = None):
+        self.form_id = form_id or make_form_id(user_id, filled_at)
+        self.user_id = user_id
+        self.username = username
+        self.system = system
+        # Строки из формы, как их ввёл пользователь (для отчётов)
+        self.date_up = date_up
+        self.time_up = time_up
+        self.control = control
+        # Разобранные моменты времени (UTC)
+        self.filled_at = filled_at
+        self.exit_at = exit_at
+        self.control_at = control_at
+        # Фактический выход (отметка «Вышел»), None — форма ещё активна
+        self.exited_at = exited_at
+        self.report_msg_ids = report_msg_ids if report_msg_ids is not None else []
+        self.chat_ids = chat_ids if chat_ids is not None else []
+        # Отправленные уведомления о сроках: [chat_id, message_id, HTML-текст] — при выходе они правятся
+        self.alert_msgs = alert_msgs if alert_msgs is not None else []
+        self.not_exited_notified = not_exited_notified
+        self.alarm_notified = alarm_notified
+        # Стадии уведомлений без прежних отметок: имя стадии -> номер следующего срока стадии
+        self.escalation = escalation if escalation is not None else {}
+        # HTML-текст отчёта, отправленного в чаты (формируется один раз при заполнении)
+        self.summary = summary
+        self._report_link = None
+
+    def report_pairs(self):
+        """Пары (chat_id, message_id) сообщений-отчётов формы."""
+        return zip(self.chat_ids, self.report_msg_ids)
+
+    def report_link(self) -> str:
+        """Ссылки t.me на сообщения-отчёты через " | " (вычисляются один раз)."""
+        if self._report_link is None:
+            if self.report_msg_ids and self.chat_ids:
+                links = []
+                for cid, mid in self.report_pairs():
+                    cid_str = str(cid)
+                    if cid_str.startswith("-100"):
+                        links.append(f"https://t.me/c/{cid_str[4:]}/{mid}")
+                    else:
+                        links.append("Нет ссылки")
+                self._report_link = " | ".join(links)
+            else:
+                self._report_link = "Нет ссылки"
+        return self._report_link
+
+    def to_dict(self) -> dict:
+        return {
+            "form_id": self.form_id,
+            "report_msg_ids": self.report_msg_ids,
+            "chat_ids": self.chat_ids,
+            "alert_msgs": self.alert_msgs,
+            "date_up": self.date_up,
+            "time_up": self.time_up,
+            "control": self.control,
+            "filled_at": self.filled_at.isoformat() if self.filled_at else None,
+            "exit_ts": self.exit_at.timestamp() if self.exit_at else None,
+            "control_ts": self.control_at.timestamp() if self.control_at else None,
+            "exited_ts": self.exited_at.timestamp() if self.exited_at else None,
+            "not_exited_notified": self.not_exited_notified,
+            "alarm_notified": self.alarm_notified,
+            "escalation": self.escalation,
+            "user_id": self.user_id,
+            "username": self.username,
+            "system": self.system,
+            "summary": self.summary,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FormRecord":
+        user_id = data.get("user_id")
+        return cls(
+            user_id=int(user_id) if user_id is not None else None,
+            username=data.get("username"),
+            system=data.get("system"),
+            date_up=data.get("date_up"),
+            time_up=data.get("time_up"),
+            control=data.get("control"),
+            filled_at=_parse_utc(data.get("filled_at")),
+            exit_at=_from_ts(data.get("exit_ts")),
+            control_at=_from_ts(data.get("control_ts")),
+            report_msg_ids=[int(mid) for mid in data.get("report_msg_ids", [])],
+            chat_ids=[int(cid) for cid in data.get("chat_ids", [])],
+            not_exited_notified=bool(data.get("not_exited_notified", False)),
+            alarm_notified=bool(data.get("alarm_notified", False)),
+            summary=data.get("summary"),
+            form_id=data.get("form_id"),
+            exited_at=_from_ts(data.get("exited_ts")),
+            escalation={name: int(index) for name, index in (data.get("escalation") or {}).items()},
+            alert_msgs=[[int(cid), int(mid), text] for cid, mid, text in data.get("alert_msgs") or []],
+        )
@@ -0,0 +1,94 @@
+"""
+Отправка запросов к Telegram с учётом ограничений частоты.
+
+Лимиты Telegram: около 30 сообщений в секунду на бота, 1 сообщение в секунду
+в личный чат и 20 сообщений в минуту в группу. Каждый лимит — отдельная
+корзина токенов; при ответе RetryAfter ждёт только тот запрос, который его получил,
+остальные чаты продолжают отправку.
+"""
+import asyncio
+import datetime
+import logging
+import time
+
+from telegram.error import RetryAfter
+
+from metrics import TELEGRAM_ERRORS, TELEGRAM_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SendDispatcher:
+    """Вызовы методов бота через общий и початовые лимиты с повтором при RetryAfter."""
+
+    def __init__(self, global_rate: float = 30, private_rate: float = 1,
+                 group_rate: float = 20 / 60, group_burst: float = 20, max_retries: int = 3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self._chat_buckets = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные id — группы и каналы
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, 1)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def call(self, chat_id: int, method, /, *args, **kwargs):
+        """Вызов method(*args, **kwargs) для чата chat_id. Ошибки, кроме RetryAfter, пробрасываются."""
+        bucket = self._chat_bucket(int(chat_id))
+        method_name = getattr(method, "__name__", "unknown")
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            except Exception as e:
+                TELEGRAM_ERRORS.inc(method=method_name, error=type(e).__name__)
+                if not isinstance(e, RetryAfter):
+                    raise
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                delay = e.retry_after
+            finally:
+                # Время только самого запроса, без ожидания лимитов и повтора
+                TELEGRAM_SECONDS.observe(time.perf_counter() - start, method=method_name)
+            if isinstance(delay, datetime.timedelta):
+                delay = delay.total_seconds()
+            logger.warning(f"Превышен лимит отправки в чат {chat_id}, повтор через {delay} с.")
+            await asyncio.sleep(delay)
+
+    async def send_message(self, bot, chat_id: int, text: str, **kwargs):
+        return await self.call(chat_id, bot.send_message, chat_id, text, **kwargs)
@@ -0,0 +1,102 @@
+"""
+Сериализация файлов данных: снимков форм и журнала, строк журнала изменений и архива.
+
+Форматы снимков: "json" — компактный JSON (через orjson, если он установлен),
+"msgpack" — двоичный msgpack (нужен пакет msgpack). Формат файла при чтении
+определяется по содержимому, поэтому старые файлы с отступами и файлы
+другого формата читаются без настройки.
+orjson и msgpack загружаются при первом использовании; без них работает стандартный json.
+"""
+import gc
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("json", "msgpack")
+
+# Модули после первой загрузки; False — библиотека не установлена
+_orjson = None
+_msgpack = None
+
+
+def _load_orjson():
+    global _orjson
+    if _orjson is None:
+        try:
+            import orjson
+            _orjson = orjson
+        except ImportError:
+            _orjson = False
+    return _orjson or None
+
+
+def _load_msgpack():
+    global _msgpack
+    if _msgpack is None:
+        try:
+            import msgpack
+            _msgpack = msgpack
+        except ImportError:
+            logger.warning("msgpack не установлен, снимки будут записываться в JSON.")
+            _msgpack = False
+    return _msgpack or None
+
+
+def json_backend() -> str:
+    """Библиотека, которой разбирается и пишется JSON."""
+    return "orjson" if _load_orjson() is not None else "json"
+
+
+def dumps_line(data) -> str:
+    """Компактная строка JSON без перевода строки (журнал изменений, архив)."""
+    orjson = _load_orjson()
+    if orjson is not None:
+        return orjson.dumps(data, default=str, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False, default=str, separators=(",", ":"))
+
+
+def loads_line(line):
+    """Разбор строки JSON; ошибка разбора — ValueError (json.JSONDecodeError тоже ValueError)."""
+    orjson = _load_orjson()
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def snapshot_format(fmt: str) -> str:
+    """Формат, в котором снимок будет записан на самом деле (msgpack без библиотеки — JSON)."""
+    if fmt == "msgpack" and _load_msgpack() is None:
+        return "json"
+    return fmt
+
+
+def dumps(data, fmt: str = "json") -> bytes:
+    """Снимок в байтах в формате fmt."""
+    if snapshot_format(fmt) == "msgpack":
+        return _msgpack.packb(data, default=str, use_bin_type=True)
+    return dumps_line(data).encode("utf-8")
+
+
+def loads(raw: bytes):
+    """
+    Разбор снимка любого поддерживаемого формата. JSON (в том числе с отступами)
+    начинается с "{" или "[" после пробельных символов; иначе это msgpack.
+    """
+    head = raw.lstrip()[:1]
+    msgpack = None
+    if head not in (b"{", b"[") and head:
+        msgpack = _load_msgpack()
+        if msgpack is None:
+            raise ValueError("снимок в формате msgpack, но пакет msgpack не установлен")
+    # Сборщик циклов при разборе миллионов новых объектов ищет циклы впустую —
+    # на время разбора он отключается (это примерно вдвое ускоряет загрузку большого журнала)
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if msgpack is not None:
+            return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+        return loads_line(raw)
+    finally:
+        if gc_enabled:
+            gc.enable()
@@ -0,0 +1,109 @@
+"""
+Накопительная статистика по формам.
+
+Счётчики обновляются по событиям (заполнение формы, выход, уведомление о сроке)
+и хранятся одним небольшим словарём, поэтому /count и /stats не перебирают
+активные формы и журнал.
+"""
+
+
+class FormStats:
+    """Активные формы по системам, выходы по месяцам, опоздания и уведомления."""
+
+    def __init__(self):
+        # система -> активных форм (формы без системы не учитываются, как и раньше в /count)
+        self.active_by_system = {}
+        # "YYYY-MM" (месяц выхода) -> {система: форм}
+        self.trips = {}
+        # Отклонение фактического выхода от заявленного времени выхода (секунды)
+        self.exit_delay_sum = 0.0
+        self.exit_count = 0
+        self.late_exit_count = 0
+        # Стадия уведомления ("exit" — не вышел, "control" — аларм, остальные — из ESCALATION_STAGES) -> отправлено
+        self.alerts = {"exit": 0, "control": 0}
+        # Приращения счётчиков с прошлого take_changes (FormStats) или None, если они не отслеживаются
+        self.changes = None
+
+    def add_form(self, system, month: str) -> None:
+        """Новая активная форма с выходом в месяце month."""
+        if system is not None:
+            self.active_by_system[system] = self.active_by_system.get(system, 0) + 1
+        self.add_trip(system, month)
+
+    def add_trip(self, system, month: str) -> None:
+        by_system = self.trips.setdefault(month, {})
+        key = system or "—"
+        by_system[key] = by_system.get(key, 0) + 1
+        if self.changes is not None:
+            self.changes.add_trip(system, month)
+
+    def remove_form(self, system, exit_delay: float = None) -> None:
+        """Выход по форме. exit_delay — секунды после заявленного времени выхода (отрицательные — раньше)."""
+        if system is not None and system in self.active_by_system:
+            self.active_by_system[system] -= 1
+            if self.active_by_system[system] <= 0:
+                del self.active_by_system[system]
+        if exit_delay is not None:
+            self.exit_delay_sum += exit_delay
+            self.exit_count += 1
+            if exit_delay > 0:
+                self.late_exit_count += 1
+            if self.changes is not None:
+                self.changes.remove_form(None, exit_delay)
+
+    def add_alert(self, kind: str) -> None:
+        self.alerts[kind] = self.alerts.get(kind, 0) + 1
+        if self.changes is not None:
+            self.changes.add_alert(kind)
+
+    def track_changes(self) -> None:
+        """Учёт приращений счётчиков (общая статистика нескольких процессов, см. take_changes)."""
+        self.changes = FormStats()
+
+    def take_changes(self) -> dict:
+        """Приращения счётчиков с прошлого вызова в виде to_dict; учёт начинается заново."""
+        changes, self.changes = self.changes, FormStats()
+        return changes.to_dict()
+
+    def merge(self, data: dict) -> None:
+        """Прибавление счётчиков из словаря to_dict (активные формы не складываются — они считаются по факту)."""
+        for month, by_system in data.get("trips", {}).items():
+            target = self.trips.setdefault(month, {})
+            for system, count in by_system.items():
+                target[system] = target.get(system, 0) + count
+        self.exit_delay_sum += float(data.get("exit_delay_sum", 0.0))
+        self.exit_count += int(data.get("exit_count", 0))
+        self.late_exit_count += int(data.get("late_exit_count", 0))
+        for kind, count in data.get("alerts", {}).items():
+            self.alerts[kind] = self.alerts.get(kind, 0) + count
+
+    def reset_active(self, systems) -> None:
+        """Пересчёт активных форм по системам (после перечитывания набора активных форм)."""
+        self.active_by_system = {}
+        for system in systems:
+            if system is not None:
+                self.active_by_system[system] = self.active_by_system.get(system, 0) + 1
+
+    def average_exit_delay(self):
+        return self.exit_delay_sum / self.exit_count if self.exit_count else None
+
+    def to_dict(self) -> dict:
+        return {
+            "active_by_system": dict(self.active_by_system),
+            "trips": {month: dict(by_system) for month, by_system in self.trips.items()},
+            "exit_delay_sum": self.exit_delay_sum,
+            "exit_count": self.exit_count,
+            "late_exit_count": self.late_exit_count,
+            "alerts": dict(self.alerts),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FormStats":
+        stats = cls()
+        stats.active_by_system = dict(data.get("active_by_system", {}))
+        stats.trips = {month: dict(by_system) for month, by_system in data.get("trips", {}).items()}
+        stats.exit_delay_sum = float(data.get("exit_delay_sum", 0.0))
+        stats.exit_count = int(data.get("exit_count", 0))
+        stats.late_exit_count = int(data.get("late_exit_count", 0))
+        stats.alerts.update(data.get("alerts", {}))
+        return stats
@@ -0,0 +1,569 @@
+"""
+Хранилище данных бота: атомарные снимки (JSON или msgpack, см. serializer)
+и журнал изменений (write-ahead log) либо, по настройке, база SQLite.
+
+Каждое изменение форм дописывается одной строкой JSON в конец лога,
+а полные снимки файлов пишутся только при периодическом сжатии лога.
+Запись на диск выполняет отдельный поток PersistenceWorker, чтобы не блокировать цикл событий.
+Старые записи журнала форм переносятся в сжатые помесячные сегменты (JournalArchive).
+"""
+import gzip
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import serializer
+
+from metrics import PERSISTENCE_BYTES, PERSISTENCE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def atomic_write_bytes(path: str, data: bytes) -> None:
+    """Запись файла через временный файл и os.replace — файл никогда не остаётся полузаписанным."""
+    tmp_path = f"{path}.tmp"
+    with PERSISTENCE_SECONDS.time(kind="snapshot"):
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    PERSISTENCE_BYTES.inc(len(data), kind="snapshot")
+
+
+def atomic_write_json(path: str, data, **dump_kwargs) -> None:
+    """Атомарная запись JSON (небольшие файлы настроек и статистики, читаемые человеком)."""
+    atomic_write_bytes(path, json.dumps(data, ensure_ascii=False, **dump_kwargs).encode("utf-8"))
+
+
+def read_snapshot(path: str, key: str, default):
+    """
+    Чтение снимка. Возвращает (данные, номер последней применённой записи лога).
+    Поддерживает старый формат файла без обёртки {"wal_seq": ..., key: ...}
+    и любой формат сериализации (JSON с отступами, компактный JSON, msgpack).
+    """
+    if not os.path.exists(path):
+        return default, 0
+    with open(path, "rb") as f:
+        data = serializer.loads(f.read())
+    if isinstance(data, dict) and "wal_seq" in data and key in data:
+        return data[key], int(data["wal_seq"])
+    return data, 0
+
+
+def write_snapshot(path: str, key: str, data, wal_seq: int, fmt: str = "json") -> None:
+    atomic_write_bytes(path, serializer.dumps({"wal_seq": wal_seq, key: data}, fmt))
+
+
+def append_lines(path: str, lines: list) -> None:
+    """Дозапись строк в конец файла одним вызовом write и одним fsync."""
+    data = "".join(line + "\n" for line in lines).encode("utf-8")
+    with PERSISTENCE_SECONDS.time(kind="wal"):
+        with open(path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+    PERSISTENCE_BYTES.inc(len(data), kind="wal")
+
+
+class PersistenceWorker:
+    """
+    Единственный поток, который пишет файлы данных.
+
+    Дозаписи, накопившиеся в очереди, объединяются: в файл — одной записью с одним fsync,
+    в SQLiteStorage — одной транзакцией.
+    Задачи полной перезаписи файла передаются с ключом: если задача с тем же ключом
+    ещё не выполнена, она заменяется более новой (пишется только последнее состояние).
+    Порядок дозаписей и задач сохраняется.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._pending_writes = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+            self._thread.start()
+
+    def append(self, target, item) -> None:
+        """Дозапись: target — путь к файлу (item — строка) или объект с методом write_batch."""
+        self._queue.put(("append", target, item))
+
+    def write(self, key: str, func) -> None:
+        """Постановка перезаписи файла; func вызывается в потоке записи."""
+        with self._lock:
+            coalesced = key in self._pending_writes
+            self._pending_writes[key] = func
+        if not coalesced:
+            self._queue.put(("write", key, None))
+
+    def flush(self) -> None:
+        """Ожидание записи всего, что уже поставлено в очередь."""
+        if self._thread is None:
+            # Поток не запущен — пишем в текущем потоке
+            batch = list(self._drain())
+            self._process([item for item in batch if item is not None])
+            for _ in batch:
+                self._queue.task_done()
+            return
+        self._queue.join()
+
+    def stop(self) -> None:
+        """Запись оставшихся данных и остановка потока."""
+        if self._thread is None:
+            self.flush()
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _drain(self):
+        while True:
+            try:
+                yield self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            batch.extend(self._drain())
+            stop = None in batch
+            try:
+                self._process([item for item in batch if item is not None])
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def _process(self, batch: list) -> None:
+        # Подряд идущие дозаписи в один файл объединяются
+        appends = {}
+        for kind, target, line in batch:
+            if kind == "append":
+                appends.setdefault(target, []).append(line)
+                continue
+            self._flush_appends(appends)
+            with self._lock:
+                func = self._pending_writes.pop(target, None)
+            if func is None:
+                continue
+            try:
+                func()
+            except Exception as e:
+                logger.error(f"Ошибка записи данных ({target}): {e}")
+        self._flush_appends(appends)
+
+    def _flush_appends(self, appends: dict) -> None:
+        for target, items in appends.items():
+            try:
+                if isinstance(target, str):
+                    append_lines(target, items)
+                else:
+                    target.write_batch(items)
+            except Exception as e:
+                logger.error(f"Ошибка дозаписи в {target}: {e}")
+        appends.clear()
+
+
+class WriteAheadLog:
+    """Журнал изменений: одна строка JSON на операцию, только дозапись в конец файла."""
+
+    def __init__(self, path: str, worker: PersistenceWorker = None):
+        self.path = path
+        self.worker = worker
+        self.seq = 0        # номер последней записанной операции
+        self.pending = 0    # количество операций с момента последнего сжатия
+
+    def _read(self):
+        """Операции лога по порядку до первой повреждённой строки и признак повреждения."""
+        if not os.path.exists(self.path):
+            return [], False
+        entries = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = serializer.loads_line(line)
+                except ValueError:
+                    return entries, line_no
+                entries.append(entry)
+        return entries, False
+
+    def replay(self):
+        """
+        Чтение всех операций лога по порядку.
+        Оборванная последняя строка (сбой во время записи) пропускается.
+        """
+        entries, corrupted = self._read()
+        if corrupted:
+            logger.warning(f"Повреждённая запись в {self.path} (строка {corrupted}), дальнейшие записи пропущены.")
+            # Переписываем лог без оборванного хвоста, чтобы новые записи не оказались после него
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for entry in entries:
+                    f.write(serializer.dumps_line(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        if entries:
+            self.seq = max(self.seq, entries[-1]["seq"])
+        self.pending = len(entries)
+        return entries
+
+    def entries(self) -> list:
+        """
+        Операции лога по порядку без исправления файла и без изменения счётчиков:
+        можно читать из другого потока, пока поток записи дописывает лог
+        (недописанная последняя строка просто не попадает в результат).
+        """
+        return self._read()[0]
+
+    def append(self, op: str, **fields) -> int:
+        """
+        Добавление операции. При наличии потока записи строка только ставится
+        в очередь, и вызов не ждёт диска.
+        """
+        self.seq += 1
+        entry = {"seq": self.seq, "op": op, **fields}
+        line = serializer.dumps_line(entry)
+        if self.worker is not None:
+            self.worker.append(self.path, line)
+        else:
+            append_lines(self.path, [line])
+        self.pending += 1
+        return self.seq
+
+    def truncate(self) -> None:
+        """
+        Очистка лога после того, как все операции попали в снимки.
+        Записи, дописанные позже, но с номером не больше номера снимка,
+        при повторе пропускаются, поэтому порядок с записью снимков не критичен.
+        """
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class JournalArchive:
+    """
+    Архив журнала форм: один сжатый JSONL-файл на месяц (YYYY-MM.jsonl.gz).
+    Сегменты читаются только по запросу; запись сегмента — атомарная замена файла.
+    """
+
+    SUFFIX = ".jsonl.gz"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, month: str) -> str:
+        return os.path.join(self.directory, f"{month}{self.SUFFIX}")
+
+    def months(self) -> list:
+        """Месяцы имеющихся сегментов по возрастанию."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name[:-len(self.SUFFIX)] for name in os.listdir(self.directory) if name.endswith(self.SUFFIX))
+
+    def read(self, month: str):
+        """Записи (словари) сегмента по порядку."""
+        with gzip.open(self.path(month), "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield serializer.loads_line(line)
+
+    def iter_records(self, month_from: str = None, month_to: str = None):
+        """Записи сегментов с month_from по month_to включительно (YYYY-MM), от старых к новым."""
+        for month in self.months():
+            if month_from and month < month_from:
+                continue
+            if month_to and month > month_to:
+                break
+            yield from self.read(month)
+
+    def add(self, month: str, records: list) -> None:
+        """
+        Дописывание записей в сегмент месяца. Сегмент перезаписывается целиком;
+        записи, которые в нём уже есть (по user_id и filled_at), пропускаются —
+        повтор после сбоя не создаёт дубликатов.
+        """
+        existing = list(self.read(month)) if os.path.exists(self.path(month)) else []
+        keys = {(data.get("user_id"), data.get("filled_at")) for data in existing}
+        merged = existing + [data for data in records if (data.get("user_id"), data.get("filled_at")) not in keys]
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(month)
+        tmp_path = f"{path}.tmp"
+        with PERSISTENCE_SECONDS.time(kind="segment"):
+            with open(tmp_path, "wb") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                    for data in merged:
+                        f.write((serializer.dumps_line(data) + "\n").encode("utf-8"))
+                raw.flush()
+                os.fsync(raw.fileno())
+                size = raw.tell()
+            os.replace(tmp_path, path)
+        PERSISTENCE_BYTES.inc(size, kind="segment")
+
+    def drop_before(self, month: str) -> list:
+        """Удаление сегментов старше month. Возвращает удалённые месяцы."""
+        dropped = [m for m in self.months() if m < month]
+        for m in dropped:
+            os.remove(self.path(m))
+        return dropped
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS forms (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid TEXT NOT NULL,            -- form_id (в старых базах — id пользователя)
+    active INTEGER NOT NULL DEFAULT 1,
+    user_id INTEGER,
+    system_key TEXT,
+    date_up TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS forms_active_uid ON forms(uid) WHERE active = 1;
+CREATE INDEX IF NOT EXISTS forms_user_id ON forms(user_id);
+CREATE INDEX IF NOT EXISTS forms_system_date ON forms(system_key, date_up);
+CREATE INDEX IF NOT EXISTS forms_date_up ON forms(date_up);
+CREATE TABLE IF NOT EXISTS report_messages (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    form_id INTEGER NOT NULL REFERENCES forms(id),
+    PRIMARY KEY (chat_id, message_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS known_chats (
+    chat_id TEXT PRIMARY KEY,
+    title TEXT
+);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,        -- "forms" — статистика, "status_board" — сообщения табло
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+class SQLiteStorage:
+    """
+    Хранилище форм, журнала и известных чатов в SQLite (режим WAL).
+
+    Принимает те же операции, что и журнал изменений (create, exit, flag).
+    Активные формы загружаются в память при запуске, журнал читается только
+    по запросу с использованием индексов по системе и дате выхода.
+    Базу могут одновременно использовать несколько процессов бота (см. acquire_lease).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Соединение общее для потока записи и основного потока, обращения к нему — под lock.
+        # timeout — ожидание блокировки базы, пока пишет другой процесс.
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.lock = threading.RLock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+
+    def __str__(self) -> str:
+        return self.path
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT (SELECT COUNT(*) FROM forms) + (SELECT COUNT(*) FROM known_chats)"
+            ).fetchone()
+        return row[0] == 0
+
+    def load_active(self) -> dict:
+        with self.lock:
+            rows = self.conn.execute("SELECT uid, data FROM forms WHERE active = 1 ORDER BY id").fetchall()
+        return {uid: serializer.loads_line(data) for uid, data in rows}
+
+    def load_known_chats(self) -> dict:
+        with self.lock:
+            return dict(self.conn.execute("SELECT chat_id, title FROM known_chats"))
+
+    def active_for_user(self, user_id: int) -> list:
+        """Активные формы пользователя (словари), в том числе созданные другими процессами."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT data FROM forms WHERE user_id = ? AND active = 1", (user_id,)
+            ).fetchall()
+        return [serializer.loads_line(data) for (data,) in rows]
+
+    def rekey_active(self, pairs: list) -> None:
+        """Замена ключа активных форм (прежде — id пользователя) на form_id: пары (старый ключ, form_id)."""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE forms SET uid = ?2, data = json_set(data, '$.form_id', ?2) WHERE uid = ?1 AND active = 1",
+                pairs
+            )
+
+    def find_active_by_report(self, chat_id: int, message_id: int):
+        """Активная форма по сообщению-отчёту: (uid, словарь записи) или None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT f.uid, f.data FROM report_messages r JOIN forms f ON f.id = r.form_id "
+                "WHERE r.chat_id = ? AND r.message_id = ? AND f.active = 1",
+                (chat_id, message_id)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """
+        Захват или продление аренды name на ttl секунд.
+        Аренду получает владелец, если она свободна, истекла или уже принадлежит ему;
+        возвращает True, если после вызова аренда у owner.
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                (name, owner, now + ttl, now)
+            )
+            row = self.conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] == owner
+
+    def release_lease(self, name: str, owner: str) -> None:
+        """Освобождение аренды при остановке, чтобы другой процесс забрал её сразу."""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def write_batch(self, entries: list) -> None:
+        """Применение пачки операций одной транзакцией."""
+        with PERSISTENCE_SECONDS.time(kind="sqlite"), self.lock, self.conn:
+            for entry in entries:
+                self._apply(entry)
+
+    def _apply(self, entry: dict) -> None:
+        op = entry["op"]
+        # Ключ активной формы — form_id (в старых операциях — uid)
+        key = entry.get("form_id") or entry["uid"]
+        if op == "create":
+            self._insert_form(key, entry["record"], active=True)
+        elif op == "exit":
+            # Запись формы остаётся в журнале с временем фактического выхода
+            self.conn.execute(
+                "UPDATE forms SET active = 0, data = json_set(data, '$.exited_ts', ?) WHERE uid = ? AND active = 1",
+                (entry.get("ts"), key)
+            )
+        elif op == "flag":
+            self.conn.execute(
+                "UPDATE forms SET data = json_set(data, '$.' || ?, json(?)) WHERE uid = ? AND active = 1",
+                (entry["field"], json.dumps(entry["value"]), key)
+            )
+
+    def _insert_form(self, uid: str, record: dict, active: bool) -> None:
+        system = record.get("system")
+        cursor = self.conn.execute(
+            "INSERT INTO forms (uid, active, user_id, system_key, date_up, data) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                uid,
+                1 if active else 0,
+                record.get("user_id"),
+                system.casefold() if system else None,
+                (record.get("date_up") or "")[:10] or None,
+                serializer.dumps_line(record),
+            )
+        )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO report_messages (chat_id, message_id, form_id) VALUES (?, ?, ?)",
+            [(cid, mid, cursor.lastrowid) for cid, mid in zip(record.get("chat_ids", []), record.get("report_msg_ids", []))]
+        )
+
+    def save_known_chats(self, chats: dict) -> None:
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM known_chats")
+            self.conn.executemany("INSERT INTO known_chats (chat_id, title) VALUES (?, ?)", chats.items())
+
+    def load_stats(self, name: str):
+        """Сохранённый словарь (статистика, состояние табло) или None."""
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM stats WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_stats(self, name: str, data: dict) -> None:
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stats (name, data) VALUES (?, ?)",
+                (name, json.dumps(data, ensure_ascii=False))
+            )
+
+    def update_stats(self, name: str, update) -> dict:
+        """
+        Изменение сохранённого словаря в одной транзакции: update(прежние данные или None) -> новые.
+        Транзакция берёт блокировку записи сразу, поэтому процессы не затирают изменения друг друга.
+        """
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute("SELECT data FROM stats WHERE name = ?", (name,)).fetchone()
+            data = update(json.loads(row[0]) if row else None)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stats (name, data) VALUES (?, ?)",
+                (name, json.dumps(data, ensure_ascii=False))
+            )
+        return data
+
+    def import_json(self, active: dict, journal: list, known_chats: dict) -> None:
+        """
+        Однократный перенос данных из JSON-файлов.
+        Активная форма сопоставляется со своей записью журнала по (user_id, filled_at).
+        """
+        active_by_key = {(data.get("user_id"), data.get("filled_at")): (uid, data) for uid, data in active.items()}
+        with self.lock, self.conn:
+            for record in journal:
+                match = active_by_key.pop((record.get("user_id"), record.get("filled_at")), None)
+                if match is None:
+                    # Записи старого журнала без form_id — по id пользователя, как в старых базах
+                    self._insert_form(record.get("form_id") or str(record.get("user_id")), record, active=False)
+                else:
+                    uid, data = match
+                    self._insert_form(uid, data, active=True)
+            for uid, data in active_by_key.values():
+                self._insert_form(uid, data, active=True)
+        self.save_known_chats(known_chats)
+
+    def iter_journal(self, date_from=None, date_to=None, system_key=None):
+        """
+        Записи журнала (словари) по порядку заполнения с фильтром по дате выхода и системе.
+        Открывает собственное соединение, поэтому может выполняться в любом потоке.
+        """
+        conditions = []
+        params = []
+        if date_from:
+            conditions.append("date_up >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("date_up <= ?")
+            params.append(date_to)
+        if system_key:
+            conditions.append("system_key = ?")
+            params.append(system_key)
+        query = "SELECT data FROM forms"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id"
+        conn = sqlite3.connect(self.path)
+        try:
+            for (data,) in conn.execute(query, params):
+                yield serializer.loads_line(data)
+        finally:
+            conn.close()
@@ -0,0 +1,85 @@
+"""
+Получение обновлений через webhook: локальный HTTP-сервер на aiohttp.
+
+Telegram (или любой локальный клиент) присылает Update в JSON методом POST,
+сервер проверяет секретный токен, кладёт обновление в очередь приложения
+и сразу отвечает 200 — обработка идёт параллельно в Application.
+"""
+import asyncio
+import hmac
+import logging
+import signal
+
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def build_web_app(application: Application, path: str, secret_token: str):
+    """aiohttp-приложение с одним обработчиком POST /path."""
+    from aiohttp import web
+
+    async def handle_update(request):
+        # Сравнение байтов: для строк compare_digest принимает только ASCII. aiohttp декодирует заголовки
+        # с surrogateescape — так же кодируем обратно, иначе заголовок с неверным UTF-8 дал бы ошибку 500
+        header = request.headers.get(SECRET_HEADER, "").encode("utf-8", "surrogateescape")
+        if secret_token and not hmac.compare_digest(header, secret_token.encode("utf-8")):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            logger.warning(f"Некорректное обновление в webhook: {e}")
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    web_app = web.Application()
+    web_app.router.add_post(f"/{path.lstrip('/')}", handle_update)
+    return web_app
+
+
+async def run_webhook_server(application: Application, listen: str, port: int, path: str,
+                             secret_token: str = "", webhook_url: str = "", max_connections: int = 40) -> None:
+    """
+    Запуск приложения с приёмом обновлений через webhook до SIGINT/SIGTERM.
+    Если webhook_url пуст, адрес в Telegram не регистрируется — так сервер можно
+    проверять локально, отправляя ему Update вручную.
+    """
+    from aiohttp import web
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows: остановка только через KeyboardInterrupt
+            pass
+
+    runner = web.AppRunner(build_web_app(application, path, secret_token))
+    async with application:
+        if webhook_url:
+            await application.bot.set_webhook(
+                url=webhook_url,
+                secret_token=secret_token or None,
+                max_connections=max_connections,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info(f"Webhook зарегистрирован: {webhook_url}")
+        await application.start()
+        await runner.setup()
+        site = web.TCPSite(runner, listen, port)
+        await site.start()
+        logger.info(f"Webhook-сервер слушает {listen}:{port}/{path.lstrip('/')}")
+        try:
+            await stop_event.wait()
+        finally:
+            await runner.cleanup()
+            await application.stop()
+    # Как run_polling/run_webhook в PTB: post_shutdown после остановки приложения
+    if application.post_shutdown:
+        await application.post_shutdown(application)